@@ -4,7 +4,7 @@
 {
     #  Information
     'name': 'eAK: Sync Invoices and vendor bills',
-    'version': '17.0.0.1.2',
+    'version': '17.0.0.2.0',
     'category': 'Customization',
     'summary': "Sync Invoices and vendor bills with eAK API",
     'description': """
@@ -23,6 +23,7 @@
         'account_accountant'
     ],
     'data': [
+        'security/ir.model.access.csv',
         'data/product_data.xml',
         'data/account_edi_data.xml',
         'data/ir_cron_eak_fetch_bills.xml',
@@ -35,6 +36,9 @@
         'views/account_move_views.xml',
         'views/account_journal_dashboard_views.xml',
         'views/res_config_settings_views.xml',
+        'views/account_edi_eak_sync_run_views.xml',
+        'views/account_edi_eak_bill_quarantine_views.xml',
+        'wizard/account_move_eak_response_views.xml',
     ],
 
     # Other
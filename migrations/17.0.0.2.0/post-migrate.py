@@ -0,0 +1,62 @@
+# -*- coding: utf-8 -*-
+# Part of Odoo. See LICENSE file for full copyright and licensing details.
+import gzip
+import logging
+from odoo import api, SUPERUSER_ID
+from odoo.tools.sql import column_exists
+from odoo.addons.account_edi_eak.models.account_move import EAK_PAYLOAD_NAME, EAK_SUMMARY_SIZE
+
+_logger = logging.getLogger(__name__)
+BATCH_SIZE = 1000
+
+
+def migrate(cr, version):
+    """ eak_edi_response is no longer a column of account_move: its content moves to the gzip
+        attachments referenced by eak_edi_payload_id, then the column is dropped.
+
+        The moves are migrated by batches of BATCH_SIZE: the attachments of a batch are created
+        at once, the moves updated by one query, and the caches flushed and emptied before the
+        next batch, so that the memory used does not grow with the number of moves.
+    """
+    if not column_exists(cr, 'account_move', 'eak_edi_response'):
+        return
+    env = api.Environment(cr, SUPERUSER_ID, {})
+    moved = 0
+    last_id = 0
+    while True:
+        cr.execute("""
+            SELECT id, eak_edi_response, eak_edi_state
+              FROM account_move
+             WHERE id > %s AND eak_edi_response IS NOT NULL AND eak_edi_response != '' AND eak_edi_payload_id IS NULL
+          ORDER BY id
+             LIMIT %s
+        """, [last_id, BATCH_SIZE])
+        rows = cr.fetchall()
+        if not rows:
+            break
+        attachments = env['ir.attachment'].create([{
+            'name': EAK_PAYLOAD_NAME,
+            'raw': gzip.compress(response.encode()),
+            'res_model': 'account.move',
+            'res_id': move_id,
+            'res_field': 'eak_edi_payload_id',
+            'mimetype': 'application/gzip',
+        } for move_id, response, _state in rows])
+        env.flush_all()
+        cr.execute("""
+            UPDATE account_move move
+               SET eak_edi_payload_id = payload.attachment_id,
+                   eak_edi_summary = payload.summary
+              FROM unnest(%s::int[], %s::int[], %s::varchar[]) AS payload(move_id, attachment_id, summary)
+             WHERE move.id = payload.move_id
+        """, [
+            [move_id for move_id, _response, _state in rows],
+            attachments.ids,
+            [(state or response)[:EAK_SUMMARY_SIZE] for _move_id, response, state in rows],
+        ])
+        env.invalidate_all()
+        last_id = rows[-1][0]
+        moved += len(rows)
+        _logger.info("eAK: %s move responses moved to attachments", moved)
+    cr.execute("ALTER TABLE account_move DROP COLUMN eak_edi_response")
+    _logger.info("eAK: eak_edi_response dropped, %s move responses moved to attachments", moved)
@@ -6,6 +6,9 @@ from . import res_partner
 from . import account_move
 from . import account_journal
 from . import account_edi_eak
+from . import account_edi_eak_sync_run
+from . import account_edi_eak_bill_quarantine
 from . import account_edi_format
+from . import account_edi_document
 from . import res_config_settings
 from . import account_edi_xml_edi_eak
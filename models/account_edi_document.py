@@ -0,0 +1,74 @@
+# -*- coding: utf-8 -*-
+# Part of Odoo. See LICENSE file for full copyright and licensing details.
+from odoo import api, models
+
+# eAK documents sent per company by one run of the outbox cron
+EAK_OUTBOX_BATCH_SIZE = 50
+
+
+class AccountEdiDocument(models.Model):
+    _inherit = 'account.edi.document'
+
+    def _process_documents_web_services(self, job_count=None, with_commit=True):
+        # EXTENDS account_edi: the eAK documents to send are left to the eAK outbox cron
+        outbox = self.filtered(lambda document: document.edi_format_id.code == 'EAKs' and document.state == 'to_send')
+        if outbox:
+            self._eak_trigger_outbox()
+        return super(AccountEdiDocument, self - outbox)._process_documents_web_services(job_count=job_count, with_commit=with_commit)
+
+    def _eak_trigger_outbox(self):
+        cron = self.env.ref('account_edi_eak.ir_cron_eak_outbox', raise_if_not_found=False)
+        if cron:
+            cron.sudo()._trigger()
+
+    def _eak_outbox_domain(self):
+        return [
+            ('edi_format_id.code', '=', 'EAKs'),
+            ('state', '=', 'to_send'),
+            ('blocking_level', '!=', 'error'),
+            ('move_id.state', '=', 'posted'),
+        ]
+
+    @api.model
+    def _cron_process_eak_outbox(self, batch_size=None):
+        """ Send the queued eAK documents, oldest first. Each company gets at most ``batch_size``
+            documents per run (account_edi_eak.outbox_batch_size), so that a large backlog of one
+            company does not hold up the others, and the companies are sent concurrently by
+            res.company._eak_run_concurrently. The cron triggers itself again while documents remain,
+            and for when eAK takes calls again for the companies it is throttling.
+        """
+        batch_size = batch_size or int(self.env['ir.config_parameter'].sudo().get_param('account_edi_eak.outbox_batch_size', EAK_OUTBOX_BATCH_SIZE))
+        documents = self.search_fetch(self._eak_outbox_domain(), ['move_id'], order='id')
+        by_company = {}
+        for document in documents:
+            by_company.setdefault(document.move_id.company_id, self.browse())
+            by_company[document.move_id.company_id] |= document
+        if any(len(company_documents) > batch_size for company_documents in by_company.values()):
+            self._eak_trigger_outbox()
+        companies = self.env['res.company'].concat(*by_company)._eak_ready_companies('account_edi_eak.ir_cron_eak_outbox')
+
+        def _failed(company, eAk_response):
+            # kept to send, the next run tries again
+            results = {move: {'error': eAk_response['fault_string'], 'blocking_level': 'warning'} for move in by_company[company].move_id}
+            self._process_job({'documents': by_company[company][:batch_size], 'method_to_call': lambda moves: results})
+            return results
+
+        results = companies._eak_run_concurrently(lambda company: by_company[company][:batch_size]._eak_outbox_walk(),
+                                                  commit=True, on_error=_failed)
+        self.env['account.journal']._eak_invalidate_dashboard()
+        return results
+
+    def _eak_outbox_walk(self):
+        """ Walk for res.company._eak_run_concurrently sending the documents of ``self`` that no
+            other transaction holds, in the jobs account_edi makes of them from the eAK applicability,
+            the results being applied by account_edi's _process_job.
+        """
+        self.env.cr.execute('SELECT id FROM account_edi_document WHERE id IN %s FOR UPDATE SKIP LOCKED', [tuple(self.ids)])
+        documents = self.browse([row[0] for row in self.env.cr.fetchall()])
+        results = {}
+        for job in documents._prepare_jobs():
+            job_results = yield from job['documents'].edi_format_id._eak_post_walk(job['documents'].move_id)
+            # the job posts the moves already sent by the walk
+            self._process_job({**job, 'method_to_call': lambda moves: job_results})
+            results.update(job_results)
+        return results
@@ -1,32 +1,448 @@
 # -*- coding: utf-8 -*-
 # Part of Odoo. See LICENSE file for full copyright and licensing details.
+import io
+import os
+import re
+import copy
+import json
+import base64
+import hashlib
+import time
+import random
 import logging
+import tempfile
+import threading
+import itertools
+import http.client
+from datetime import timedelta
+from functools import partial
 import requests
+from requests.adapters import HTTPAdapter
+from requests.structures import CaseInsensitiveDict
 from odoo import _
 from lxml import etree, html
 
 _logger = logging.getLogger(__name__)
 TIMEOUT = 60
+CONNECT_TIMEOUT = 10
+# Read timeout per SOAPAction, the export and attachment answers can be large.
+ACTION_TIMEOUTS = {
+    'EInvoice': 120,
+    'BuyInvoiceExportRequest': 180,
+    'CompanyStatusRequest': TIMEOUT,
+    'InvoiceAttachmentRequest': 120,
+}
+POOL_SIZE = 16
+MAX_RETRIES = 3
+BACKOFF_FACTOR = 0.5
+BACKOFF_MAX = 30
+RETRY_STATUSES = (502, 503, 504)
+# Sending an invoice is not idempotent, it is only retried when eAK never got it.
+NON_IDEMPOTENT_ACTIONS = ('EInvoice',)
+
+# payload logging: share of the calls logged and bytes kept of each payload
+LOG_SAMPLE_RATE = 0.01
+LOG_MAX_BYTES = 2048
+AUTH_PHRASE_RE = re.compile(rb'(authPhrase\s*=\s*["\'])[^"\']*')
+# upper bounds, in seconds, of the latency histogram buckets
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, float('inf'))
+
+# per company rate of calls, in calls per second: starts at RATE_LIMIT, halved on each failure
+# or slow call, raised again by a tenth of RATE_LIMIT on each fast success
+RATE_LIMIT = 10.0
+RATE_LIMIT_MIN = 0.2
+SLOW_CALL = 10
+# longest wait for a token before a call fails fast
+MAX_THROTTLE_WAIT = 5
+# consecutive failures opening the circuit, and how long it stays open (doubled by each failed probe)
+BREAKER_FAILURES = 5
+BREAKER_COOLDOWN = 30
+BREAKER_COOLDOWN_MAX = 600
+
+_sessions = {}
+_sessions_lock = threading.Lock()
+_limiters = {}
+_limiters_lock = threading.Lock()
+_replays = {}
+_replays_lock = threading.Lock()
+# transports, set by account_edi_eak.transport
+TRANSPORT_MODES = ('live', 'record', 'replay')
+_metrics = {}
+_metrics_lock = threading.Lock()
+
+
+def _get_session(url, pool_size=POOL_SIZE):
+    """ Return the keep-alive session shared by every client of ``url`` in this process. """
+    key = (os.getpid(), url, pool_size)
+    session = _sessions.get(key)
+    if session is None:
+        with _sessions_lock:
+            session = _sessions.get(key)
+            if session is None:
+                session = requests.Session()
+                adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+                session.mount('http://', adapter)
+                session.mount('https://', adapter)
+                _sessions[key] = session
+    return session
+
+
+class EakRateLimiter:
+    """ Adaptive token bucket and circuit breaker guarding the eAK calls of one company in this
+        process. The bucket refills at ``rate`` calls per second, a rate lowered on failures and
+        slow answers and raised back on fast successes. After BREAKER_FAILURES failures in a row
+        the circuit opens: calls fail fast until the cooldown is over, then a single probe call
+        closes it again or reopens it for twice as long.
+    """
+
+    def __init__(self, max_rate=RATE_LIMIT):
+        self.lock = threading.Lock()
+        self.max_rate = max_rate
+        self.rate = max_rate
+        self.tokens = max(max_rate, 1)
+        self.updated = time.monotonic()
+        self.state = 'closed'
+        self.failures = 0
+        self.opened_until = 0
+        self.cooldown = BREAKER_COOLDOWN
+
+    def _wait(self, now):
+        """ Seconds before the next call may start, with the lock held. """
+        if self.state == 'open' and now < self.opened_until:
+            return self.opened_until - now
+        if self.state == 'half_open':
+            # a probe is running, its outcome decides
+            return 1
+        self.tokens = min(max(self.rate, 1), self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        return max(1 - self.tokens, 0) / self.rate
+
+    def retry_after(self):
+        """ Seconds before a call may be made, 0 when one may be made now. """
+        with self.lock:
+            return self._wait(time.monotonic())
+
+    def acquire(self, max_wait=MAX_THROTTLE_WAIT):
+        """ Take a token, sleeping at most ``max_wait`` seconds for it.
+
+            :return: 0 when taken, otherwise the seconds to wait before trying again
+        """
+        with self.lock:
+            now = time.monotonic()
+            if self.state == 'open' and now >= self.opened_until:
+                self.state = 'half_open'
+                return 0
+            wait = self._wait(now)
+            if self.state != 'closed' or wait > max_wait:
+                return wait
+            self.tokens -= 1
+        if wait:
+            time.sleep(wait)
+        return 0
+
+    def record(self, success, duration):
+        with self.lock:
+            if success and self.state == 'half_open':
+                self.state, self.cooldown = 'closed', BREAKER_COOLDOWN
+            self.failures = 0 if success else self.failures + 1
+            if success and duration < SLOW_CALL:
+                self.rate = min(self.rate + self.max_rate / 10, self.max_rate)
+            else:
+                self.rate = max(self.rate / 2, RATE_LIMIT_MIN)
+            if not success and (self.state == 'half_open' or self.failures >= BREAKER_FAILURES):
+                if self.state == 'half_open':
+                    self.cooldown = min(self.cooldown * 2, BREAKER_COOLDOWN_MAX)
+                self.state, self.opened_until = 'open', time.monotonic() + self.cooldown
+                _logger.warning("eAK circuit opened for %s s after %s failures", self.cooldown, self.failures)
+
+
+def _get_limiter(key, max_rate=RATE_LIMIT):
+    """ Return the rate limiter shared by every client of ``key`` (a company) in this process. """
+    limiter = _limiters.get(key)
+    if limiter is None:
+        with _limiters_lock:
+            limiter = _limiters.setdefault(key, EakRateLimiter(max_rate))
+    limiter.max_rate = max_rate
+    return limiter
+
+
+class LiveTransport:
+    """ Sends the requests to eAK on a requests session. A transport is anything with this
+        ``request`` method returning a requests.Response.
+    """
+
+    def __init__(self, session):
+        self.session = session
+
+    def request(self, method, url, headers=None, data=None, timeout=None, stream=False):
+        return self.session.request(method, url, headers=headers, data=data, timeout=timeout, stream=stream)
+
+
+def _cassette_response(url, status, headers, body, elapsed):
+    """ A requests.Response whose body is read from memory, streamed or not. """
+    response = requests.Response()
+    response.url = url
+    response.status_code = status
+    response.reason = http.client.responses.get(status, '')
+    response.headers = CaseInsensitiveDict(headers)
+    response.encoding = requests.utils.get_encoding_from_headers(response.headers)
+    response.raw = io.BytesIO(body)
+    response.elapsed = timedelta(seconds=elapsed)
+    return response
+
+
+class RecordingTransport:
+    """ Sends the requests through ``transport`` and writes each exchange to ``directory`` as a
+        JSON cassette, the auth phrase masked, for ReplayTransport. The bodies are buffered.
+    """
+
+    def __init__(self, transport, directory):
+        self.transport = transport
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+
+    def request(self, method, url, headers=None, data=None, timeout=None, stream=False):
+        if data is not None and not isinstance(data, (bytes, str)):
+            data = b''.join(data)
+        response = self.transport.request(method, url, headers=headers, data=data, timeout=timeout, stream=stream)
+        body = response.content
+        response_headers = {
+            key: value for key, value in response.headers.items()
+            if key.lower() not in ('content-encoding', 'content-length', 'transfer-encoding')
+        }
+        action = (headers or {}).get('SOAPAction', '').strip('"')
+        request_body = _redact(data.encode() if isinstance(data, str) else data or b'')
+        cassette = {
+            'action': action,
+            'request': {'headers': dict(headers or {}), 'body': request_body.decode(errors='replace')},
+            'response': {
+                'status': response.status_code,
+                'headers': response_headers,
+                'body': base64.b64encode(body).decode(),
+                'elapsed': response.elapsed.total_seconds(),
+            },
+        }
+        path = os.path.join(self.directory, f'{time.time_ns()}-{action or "request"}.json')
+        with open(path, 'w') as file:
+            json.dump(cassette, file)
+        return _cassette_response(url, response.status_code, response_headers, body, response.elapsed.total_seconds())
+
+
+class ReplayTransport:
+    """ Answers from the cassettes of ``directory`` without any network: the cassette recorded for
+        the same action and request body when there is one, otherwise the cassettes of the action in
+        turn, so that a capture can be replayed at any volume. Each answer takes ``latency``
+        seconds, or the recorded time when ``latency`` is None.
+    """
+
+    def __init__(self, directory, latency=0):
+        self.latency = latency
+        self.by_request = {}
+        by_action = {}
+        for name in sorted(os.listdir(directory)):
+            if not name.endswith('.json'):
+                continue
+            with open(os.path.join(directory, name)) as file:
+                cassette = json.load(file)
+            self.by_request[(cassette['action'], self._digest(cassette['request']['body'].encode()))] = cassette
+            by_action.setdefault(cassette['action'], []).append(cassette)
+        self.lock = threading.Lock()
+        self.by_action = {action: itertools.cycle(cassettes) for action, cassettes in by_action.items()}
+
+    @staticmethod
+    def _digest(body):
+        return hashlib.sha1(_redact(body)).hexdigest()
+
+    def request(self, method, url, headers=None, data=None, timeout=None, stream=False):
+        if data is not None and not isinstance(data, (bytes, str)):
+            data = b''.join(data)
+        action = (headers or {}).get('SOAPAction', '').strip('"')
+        cassette = self.by_request.get((action, self._digest(data.encode() if isinstance(data, str) else data or b'')))
+        if cassette is None:
+            if action not in self.by_action:
+                raise requests.ConnectionError(f"No eAK cassette recorded for {action}")
+            with self.lock:
+                cassette = next(self.by_action[action])
+        recorded = cassette['response']
+        elapsed = recorded['elapsed'] if self.latency is None else self.latency
+        time.sleep(elapsed)
+        return _cassette_response(url, recorded['status'], recorded['headers'], base64.b64decode(recorded['body']), elapsed)
+
+
+def get_transport(mode, session, directory=None, latency=0):
+    """ Transport of ``mode`` (see TRANSPORT_MODES), the replays of a directory being loaded once
+        per process.
+    """
+    if mode in ('record', 'replay') and not directory:
+        raise ValueError(f"The eAK {mode} transport needs a cassette directory")
+    if mode == 'record':
+        return RecordingTransport(LiveTransport(session), directory)
+    if mode == 'replay':
+        key = (directory, latency)
+        with _replays_lock:
+            if key not in _replays:
+                _replays[key] = ReplayTransport(directory, latency)
+            return _replays[key]
+    return LiveTransport(session)
+
+
+def _record_metrics(action, timings, bytes_sent, bytes_received, error):
+    with _metrics_lock:
+        metrics = _metrics.setdefault(action, {
+            'calls': 0, 'errors': 0, 'bytes_sent': 0, 'bytes_received': 0,
+            'timings': {phase: {'sum': 0.0, 'buckets': [0] * len(LATENCY_BUCKETS)} for phase in ('wait', 'read', 'parse')},
+        })
+        metrics['calls'] += 1
+        metrics['errors'] += bool(error)
+        metrics['bytes_sent'] += bytes_sent
+        metrics['bytes_received'] += bytes_received
+        for phase, duration in timings.items():
+            histogram = metrics['timings'][phase]
+            histogram['sum'] += duration
+            histogram['buckets'][next(i for i, bound in enumerate(LATENCY_BUCKETS) if duration <= bound)] += 1
+
+
+def get_metrics():
+    """ Snapshot of the eAK calls made by this process, per SOAPAction: call, error and byte
+        counters, and for each phase (``wait``: connection and server time until the answer headers,
+        ``read``: download of a buffered answer, ``parse``: parsing, streamed answers being read
+        while parsed) the total duration and the count of calls per LATENCY_BUCKETS bucket.
+    """
+    with _metrics_lock:
+        return copy.deepcopy(_metrics)
+
+
+def _redact(payload):
+    return AUTH_PHRASE_RE.sub(rb'\1***', payload)
+
+
+class EakSpool:
+    """ Temporary file keeping the raw XML of the records of a streamed answer as they are parsed,
+        each record only holding a callable reading its XML back.
+    """
+
+    def __init__(self):
+        self.file = tempfile.TemporaryFile()
+        self.size = 0
+
+    def store(self, text):
+        data = text.encode()
+        self.file.seek(self.size)
+        self.file.write(data)
+        offset, self.size = self.size, self.size + len(data)
+        return partial(self._read, offset, len(data))
+
+    def _read(self, offset, size):
+        self.file.seek(offset)
+        return self.file.read(size).decode()
+
 
 class EstonianEInvoice():
 
-    def __init__(self, url):
+    def __init__(self, url, pool_size=POOL_SIZE, timeouts=None, retries=MAX_RETRIES, log_sample_rate=LOG_SAMPLE_RATE, debug=False,
+                 limiter=None, transport=None):
         self.url = url
+        self.limiter = limiter
+        self.session = _get_session(url, pool_size)
+        self.transport = transport or LiveTransport(self.session)
+        self.timeouts = {**ACTION_TIMEOUTS, **(timeouts or {})}
+        self.retries = retries
+        self.log_sample_rate = log_sample_rate
+        self.debug = debug
 
-    def _synch_with_eAK_api(self, http_method="POST", headers=None, data=None):
-        try:
-            _logger.info('request url : {}'.format(self.url))
-            _logger.info('request data : {}'.format(data))
-            _logger.info('request headers : {}'.format(headers))
-            response = requests.request(
+    def _log_payload(self, direction, action, payload, sampled):
+        """ Log a payload with the auth phrase masked: truncated to LOG_MAX_BYTES for the sampled
+            calls, in full in debug mode.
+        """
+        if not (self.debug or sampled):
+            return
+        if callable(payload):
+            payload = b''.join(payload()) if self.debug else b'<streamed body>'
+        if isinstance(payload, str):
+            payload = payload.encode()
+        payload = payload or b''
+        if not self.debug and len(payload) > LOG_MAX_BYTES:
+            payload = payload[:LOG_MAX_BYTES] + b'... (%d bytes)' % len(payload)
+        payload = _redact(payload)
+        _logger.info('eAK %s %s %s:\n%s', action, direction, self.url, payload.decode(errors='replace'))
+
+    def retry_after(self):
+        """ Seconds before this client may call eAK again, 0 when it may now. """
+        return self.limiter.retry_after() if self.limiter else 0
+
+    def _backoff(self, attempt):
+        delay = min(BACKOFF_MAX, BACKOFF_FACTOR * 2 ** attempt)
+        time.sleep(random.uniform(0, delay))
+
+    def _send(self, http_method, headers, data, stream=False):
+        """ Send the request on the pooled session, retrying transient failures with a jittered
+            exponential backoff. ``data`` may be a callable returning a fresh body for each attempt.
+        """
+        action = (headers or {}).get('SOAPAction', '').strip('"')
+        timeout = (CONNECT_TIMEOUT, self.timeouts.get(action, TIMEOUT))
+        idempotent = action not in NON_IDEMPOTENT_ACTIONS
+        attempt = 0
+        while True:
+            start = time.perf_counter()
+            try:
+                response = self.transport.request(
                     http_method,
                     self.url,
                     headers=headers,
-                    data=data,
-                    timeout=TIMEOUT)
+                    data=data() if callable(data) else data,
+                    timeout=timeout,
+                    stream=stream)
+            except (requests.ConnectionError, requests.Timeout) as e:
+                if attempt >= self.retries or not (idempotent or isinstance(e, requests.ConnectTimeout)):
+                    raise
+                _logger.warning('eAK %s attempt %s failed: %s', action, attempt + 1, e)
+            else:
+                if response.status_code not in RETRY_STATUSES or attempt >= self.retries \
+                        or not (idempotent or response.status_code == 503):
+                    response.eak_duration = time.perf_counter() - start
+                    return response
+                _logger.warning('eAK %s attempt %s answered HTTP %s', action, attempt + 1, response.status_code)
+                response.close()
+            self._backoff(attempt)
+            attempt += 1
+
+    def _synch_with_eAK_api(self, http_method="POST", headers=None, data=None, parser=None):
+        error_message = ''
+        action = (headers or {}).get('SOAPAction', '').strip('"')
+        sampled = random.random() < self.log_sample_rate
+        timings, sent, received = {}, [0], 0
+        self._log_payload('request', action, data, sampled)
+        if callable(data):
+            body = data
+
+            def data():
+                sent[0] = 0
+                for chunk in body():
+                    sent[0] += len(chunk)
+                    yield chunk
+        else:
+            sent[0] = len(data or '')
+        wait = self.limiter.acquire() if self.limiter else 0
+        if wait:
+            return {'level': "error", 'fault_code': 'throttled', 'error_type': 'warning', 'retry_after': wait,
+                    'fault_string': _('eAK is not taking calls for now, next try in %s seconds.', int(wait) + 1), 'timings': timings}
+        response = None
+        try:
+            response = self._send(http_method, headers, data, stream=bool(parser))
+            timings['wait'] = response.elapsed.total_seconds()
+            timings['read'] = max(response.eak_duration - timings['wait'], 0)
             if response.status_code != 500:
                 response.raise_for_status()
-            return self._process_eAK_response(response)
+            start = time.perf_counter()
+            result = (parser or self._process_eAK_response)(response)
+            timings['parse'] = time.perf_counter() - start
+            received = response.raw.tell() if parser else len(response.content)
+            self._log_payload('response', action, result['row'] if parser else response.content, sampled)
+            _record_metrics(action, timings, sent[0], received, result.get('level') == 'error')
+            if self.limiter:
+                # a 500 carrying a SOAP fault is an answer, an HTML error page is not
+                self.limiter.record(result.get('fault_code') != 'html', response.eak_duration)
+            return {**result, 'timings': timings}
         except requests.HTTPError as e:
             if response.status_code == 401:
                 error_message = """An error occurred. This is due to invalid Token"""
@@ -36,7 +452,17 @@ class EstonianEInvoice():
                 error_message = _('Unexpected error ! please report this to your administrator.')
         except Exception as ex:
             error_message = _('Unexpected error ! please report this to your administrator. {}'.format(str(ex)))
-        return {'level': "error", 'fault_code': 'server', 'error_type': 'danger', 'fault_string': f'Could not post to eAk. \nError: ({error_message})'}
+        finally:
+            if response is not None:
+                # a streamed answer left half read, the parser or the status failing, must not hold its connection
+                response.close()
+        _logger.warning('eAK %s to %s failed: %s', action, self.url, error_message)
+        _record_metrics(action, timings, sent[0], received, True)
+        if self.limiter:
+            # wrong credentials or url say nothing about the health of eAK
+            self.limiter.record(response is not None and response.status_code < 500, getattr(response, 'eak_duration', 0))
+        return {'level': "error", 'fault_code': 'server', 'error_type': 'danger', 'fault_string': f'Could not post to eAk. \nError: ({error_message})',
+                'retry_after': self.retry_after(), 'timings': timings}
 
     def _process_eAK_response(self, response):
         """
@@ -47,18 +473,116 @@ class EstonianEInvoice():
         eAK_xml_response = etree.XML(response.text)
         status_code = response.status_code
         row = etree.tostring(eAK_xml_response, encoding='unicode', pretty_print=True)
-        _logger.info('response from eAK (HTTP status {}) ::: \n{}'.format(status_code, row))
         vals = {'row': row, 'level': 'info'}
-        error_code = int(eAK_xml_response.findtext('.//ErrorCode', True))
+        invoices = self._parse_invoice_results(eAK_xml_response)
+        if invoices:
+            vals['invoices'] = invoices
+        error_code = int(next((code.text for code in eAK_xml_response.iter('ErrorCode') if code.getparent().get('invoiceId') is None), True))
         if not error_code and status_code == 200:
             return vals
         fault_code = eAK_xml_response.findtext('.//faultcode', False)
         fault_string = eAK_xml_response.findtext('.//faultstring', False)
         if fault_code and fault_string:
-            return {'fault_code': fault_code, 'level': 'error', 'fault_string': f"{fault_code} : {fault_string}", **vals}
+            return {**vals, 'fault_code': fault_code, 'level': 'error', 'fault_string': f"{fault_code} : {fault_string}"}
         html_errors = html.fromstring(row)
         fault_string = " <br />".join([el.text for el in html_errors.findall(".//span")])
-        return {'fault_code': 'html', 'level': 'error', 'fault_string': fault_string, **vals}
+        return {**vals, 'fault_code': 'html', 'level': 'error', 'fault_string': fault_string}
+
+    @staticmethod
+    def _parse_invoice_results(eAK_xml_response):
+        """ Result of each invoice of an EInvoice answer, by invoiceId: eAK answers an envelope with
+            an element per invoice carrying its invoiceId, its ErrorCode and ErrorMessage.
+        """
+        invoices = {}
+        for element in eAK_xml_response.iterfind('.//*[@invoiceId]'):
+            row = etree.tostring(element, encoding='unicode', pretty_print=True)
+            error_code = element.findtext('ErrorCode', '0').strip() or '0'
+            if error_code == '0':
+                invoices[element.get('invoiceId')] = {'row': row, 'level': 'info', 'fault_code': '', 'fault_string': ''}
+                continue
+            message = element.findtext('ErrorMessage', '').strip()
+            invoices[element.get('invoiceId')] = {'row': row, 'level': 'error', 'fault_code': error_code,
+                                                  'fault_string': f"{error_code} : {message}" if message else error_code}
+        return invoices
+
+    def _iterparse_eAK_response(self, response, tag, parse_record):
+        """ Stream the response body through iterparse: every ``tag`` element is turned into a
+            compact record by ``parse_record`` then cleared, so memory does not grow with the
+            size of the answer. Errors are detected the same way as in _process_eAK_response.
+        """
+        if response.status_code != 200:
+            return self._process_eAK_response(response)
+        response.raw.decode_content = True
+        records, texts, spans = [], {}, []
+        for _event, elem in etree.iterparse(response.raw, tag=(tag, 'ErrorCode', 'faultcode', 'faultstring', '{*}span')):
+            name = etree.QName(elem).localname
+            if elem.tag == tag:
+                records.append(parse_record(elem))
+                elem.clear(keep_tail=True)
+                while elem.getprevious() is not None:
+                    del elem.getparent()[0]
+            elif name == 'span':
+                spans.append(elem.text)
+            else:
+                texts.setdefault(name, elem.text or '')
+        # drain what is left after the root element so the connection goes back to the pool
+        response.raw.read()
+        row = f"{len(records)} {tag} received"
+        vals = {'row': row, 'level': 'info', 'records': records}
+        error_code = int(texts.get('ErrorCode', True))
+        if not error_code:
+            return vals
+        fault_code = texts.get('faultcode')
+        fault_string = texts.get('faultstring')
+        if fault_code and fault_string:
+            return {**vals, 'fault_code': fault_code, 'level': 'error', 'fault_string': f"{fault_code} : {fault_string}"}
+        return {**vals, 'fault_code': 'html', 'level': 'error', 'fault_string': " <br />".join([text for text in spans if text])}
+
+    @staticmethod
+    def _parse_vendor_bill(invoice, spool=None):
+        """ Compact record of a BuyInvoiceExportRequest <Invoice> element, its ``raw`` XML being
+            read by calling it: from ``spool`` (EakSpool) when given, the record not holding it.
+        """
+        lines = []
+        for line in invoice.iterfind('.//InvoiceItem/InvoiceItemGroup/ItemEntry'):
+            discount = 0
+            for add in line.iterfind('.//Addition'):
+                if add.get('addCode') == 'DSC':
+                    discount = add.findtext('AddRate', 0)
+            lines.append({
+                'VATRate': line.findtext('.//VAT/VATRate', ''),
+                'InformationContent': line.findtext('.//ItemReserve/InformationContent', ''),
+                'Description': line.findtext('.//Description', ''),
+                'ItemAmount': line.findtext('.//ItemAmount', ''),
+                'ItemPrice': line.findtext('.//ItemPrice', ''),
+                'ItemSum': line.findtext('.//ItemSum', ''),
+                'ItemTotal': line.findtext('.//ItemTotal', ''),
+                'AddRate': discount,
+            })
+        raw = etree.tostring(invoice, encoding='unicode', with_tail=False)
+        return {
+            'invoiceId': invoice.get('invoiceId'),
+            'state': invoice.get('state') or invoice.findtext(".//InvoiceInformation/Extension[@extensionId='eakStatus']/InformationContent", ''),
+            'regNumber': invoice.get('regNumber'),
+            'SellerRegNumber': invoice.findtext('.//InvoiceParties/SellerParty/RegNumber', ''),
+            'InvoiceNumber': invoice.findtext('.//InvoiceInformation/InvoiceNumber', ''),
+            'InvoiceDate': invoice.findtext('.//InvoiceInformation/InvoiceDate', ''),
+            'DueDate': invoice.findtext('.//InvoiceInformation/DueDate', ''),
+            'Currency': invoice.findtext('.//InvoiceSumGroup/Currency', ''),
+            'PayToAccount': invoice.findtext('.//PaymentInfo/PayToAccount', ''),
+            'PaymentDescription': invoice.findtext('.//PaymentInfo/PaymentDescription', ''),
+            'lines': lines,
+            'raw': spool.store(raw) if spool else lambda: raw,
+            'digest': hashlib.sha1(raw.encode()).hexdigest(),
+        }
+
+    def _parse_invoice_attachment(self, attachment):
+        """ Record of an InvoiceAttachmentRequest <InvoiceAttachment>, its content already decoded. """
+        return {
+            'invoiceId': attachment.get('invoiceId'),
+            'fileName': attachment.get('fileName'),
+            'content': base64.b64decode(attachment.findtext('AttachmentContent') or ''),
+        }
 
     def sendCustomerInvoice(self, data=None):
         headers = {'SOAPAction': '"EInvoice"', 'Content-Type': 'text/xml'}
@@ -69,9 +593,11 @@ class EstonianEInvoice():
 
     def getVendorBills(self, data=None):
         headers = {'SOAPAction': '"BuyInvoiceExportRequest"', 'Content-Type': 'text/xml'}
+        spool = EakSpool()
         return self._synch_with_eAK_api(
             headers=headers,
             data=data,
+            parser=lambda response: self._iterparse_eAK_response(response, 'Invoice', partial(self._parse_vendor_bill, spool=spool)),
         )
 
     def getClientStatus(self, data=None):
@@ -86,4 +612,5 @@ class EstonianEInvoice():
         return self._synch_with_eAK_api(
             headers=headers,
             data=data,
+            parser=lambda response: self._iterparse_eAK_response(response, 'InvoiceAttachment', self._parse_invoice_attachment),
         )
@@ -0,0 +1,67 @@
+# -*- coding: utf-8 -*-
+# Part of Odoo. See LICENSE file for full copyright and licensing details.
+from lxml import etree
+from odoo import fields, models, _
+from .account_edi_eak import EstonianEInvoice
+
+
+class AccountEdiEakBillQuarantine(models.Model):
+    _name = 'account.edi.eak.bill.quarantine'
+    _description = "eAK Quarantined Vendor Bill"
+    _order = 'create_date desc, id desc'
+
+    company_registry = fields.Char('Company ID', required=True, readonly=True, index=True)
+    company_id = fields.Many2one('res.company', readonly=True, ondelete='cascade')
+    eak_edi_bill_id = fields.Char('eAK Bill ID', required=True, readonly=True, index=True)
+    seller_registry = fields.Char('Vendor Company ID', readonly=True)
+    invoice_number = fields.Char(readonly=True)
+    reason = fields.Text(readonly=True)
+    raw = fields.Text('eAK Bill', readonly=True)
+
+    def _quarantine(self, rejected):
+        """ Keep the export records of ``rejected`` [(record, reasons)] apart, replacing their
+            previous quarantine if any.
+        """
+        records = [record for record, _reasons in rejected]
+        self._release(records)
+        companies = {}
+        company_domain = [('company_registry', 'in', list({record['regNumber'] for record in records} - {''}))]
+        for company in self.env['res.company'].sudo().search_fetch(company_domain, ['company_registry']):
+            companies.setdefault(company.company_registry, company.id)
+        return self.sudo().create([{
+            'company_registry': record['regNumber'],
+            'company_id': companies.get(record['regNumber'], False),
+            'eak_edi_bill_id': record['invoiceId'],
+            'seller_registry': record['SellerRegNumber'],
+            'invoice_number': record['InvoiceNumber'],
+            'reason': "\n".join(reasons),
+            'raw': record['raw'](),
+        } for record, reasons in rejected])
+
+    def _release(self, records):
+        """ Drop the quarantine of the export ``records``, imported or quarantined again. """
+        keys = {(record['regNumber'], record['invoiceId']) for record in records}
+        if not keys:
+            return
+        domain = [
+            ('eak_edi_bill_id', 'in', list({bill_id for _reg, bill_id in keys})),
+            ('company_registry', 'in', list({reg for reg, _bill_id in keys})),
+        ]
+        self.sudo().search_fetch(domain, ['company_registry', 'eak_edi_bill_id']).filtered(
+            lambda entry: (entry.company_registry, entry.eak_edi_bill_id) in keys).unlink()
+
+    def action_retry(self):
+        """ Import the quarantined bills again, once their master data is fixed. """
+        records = [EstonianEInvoice._parse_vendor_bill(etree.fromstring(entry.raw)) for entry in self]
+        eAk_response = self.env['account.journal']._process_eak_vendor_bill({'records': records})
+        return {
+            'type': 'ir.actions.client',
+            'tag': 'display_notification',
+            'params': {
+                'title': _('Quarantined Vendor Bills'),
+                'type': 'info',
+                'message': eAk_response.get('row', ''),
+                'sticky': False,
+                'next': {'type': 'ir.actions.client', 'tag': 'soft_reload'},
+            }
+        }
@@ -0,0 +1,119 @@
+# -*- coding: utf-8 -*-
+# Part of Odoo. See LICENSE file for full copyright and licensing details.
+import gzip
+import time
+from datetime import timedelta
+from contextlib import contextmanager
+from odoo import api, fields, models
+
+EAK_SYNC_RUN_RETENTION_DAYS = 30
+EAK_SYNC_PHASES = ('build', 'http', 'parse', 'resolve', 'create', 'commit')
+
+
+class EakSyncStats:
+    """ What one cron run did for one company, filled in by the walks: seconds spent per phase,
+        record counts and, when account_edi_eak.store_payloads is set, the raw payloads.
+    """
+
+    def __init__(self, store_payloads=False):
+        self.date_start = fields.Datetime.now()
+        self.durations = dict.fromkeys(EAK_SYNC_PHASES, 0.0)
+        self.counts = {}
+        self.store_payloads = store_payloads
+        self.payloads = []
+
+    @contextmanager
+    def phase(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.durations[name] += time.perf_counter() - start
+
+    def add_response(self, eAk_response):
+        timings = eAk_response.get('timings') or {}
+        self.durations['http'] += timings.get('wait', 0) + timings.get('read', 0)
+        self.durations['parse'] += timings.get('parse', 0)
+
+    def count(self, **counts):
+        for key, value in counts.items():
+            self.counts[key] = self.counts.get(key, 0) + value
+
+    def payload(self, name, content):
+        if self.store_payloads:
+            self.payloads.append((name, content.encode() if isinstance(content, str) else content))
+
+
+class AccountEdiEakSyncRun(models.Model):
+    _name = 'account.edi.eak.sync.run'
+    _description = "eAK Sync Run"
+    _order = 'date_start desc, id desc'
+
+    job = fields.Selection([
+        ('vendor_bills', "Vendor Bills"),
+        ('partners', "Partner Statuses"),
+        ('attachments', "Vendor Bill Attachments"),
+    ], required=True, readonly=True)
+    company_id = fields.Many2one('res.company', required=True, readonly=True, ondelete='cascade')
+    date_start = fields.Datetime('Started', readonly=True)
+    date_end = fields.Datetime('Ended', readonly=True)
+    state = fields.Selection([('success', "Success"), ('error', "Error")], readonly=True)
+    duration_build = fields.Float('Request Build (s)', digits=(16, 3), readonly=True)
+    duration_http = fields.Float('HTTP (s)', digits=(16, 3), readonly=True)
+    duration_parse = fields.Float('Parse (s)', digits=(16, 3), readonly=True)
+    duration_resolve = fields.Float('Resolve (s)', digits=(16, 3), readonly=True)
+    duration_create = fields.Float('Create (s)', digits=(16, 3), readonly=True)
+    duration_commit = fields.Float('Commit (s)', digits=(16, 3), readonly=True)
+    count_received = fields.Integer('Received', readonly=True)
+    count_created = fields.Integer('Created', readonly=True)
+    count_updated = fields.Integer('Updated', readonly=True)
+    count_unchanged = fields.Integer('Unchanged', readonly=True)
+    bytes_received = fields.Integer('Bytes Received', readonly=True)
+    message = fields.Text(readonly=True)
+    error = fields.Text(readonly=True)
+
+    def _new_stats(self, companies):
+        store_payloads = self.env['ir.config_parameter'].sudo().get_param('account_edi_eak.store_payloads')
+        return {company: EakSyncStats(store_payloads=bool(store_payloads)) for company in companies}
+
+    def _create_runs(self, job, results, stats):
+        """ One run per company of ``results`` {company: (eAk_response, error)}, the payloads of its
+            ``stats`` being attached gzip-compressed.
+        """
+        date_end = fields.Datetime.now()
+        vals_list = []
+        for company, (eAk_response, error) in results.items():
+            company_stats = stats[company]
+            error = error or (eAk_response.get('level') == 'error' and eAk_response.get('fault_string')) or False
+            vals_list.append({
+                'job': job,
+                'company_id': company.id,
+                'date_start': company_stats.date_start,
+                'date_end': date_end,
+                'state': 'error' if error else 'success',
+                **{f'duration_{phase}': duration for phase, duration in company_stats.durations.items()},
+                **{field: company_stats.counts.get(key, 0) for key, field in (
+                    ('received', 'count_received'), ('created', 'count_created'), ('updated', 'count_updated'),
+                    ('unchanged', 'count_unchanged'), ('bytes', 'bytes_received'))},
+                'message': eAk_response.get('row', ''),
+                'error': error if isinstance(error, str) else False,
+            })
+        runs = self.sudo().create(vals_list)
+        self.env['ir.attachment'].sudo().create([
+            {
+                'name': f'{name}.xml.gz',
+                'raw': gzip.compress(content),
+                'res_model': self._name,
+                'res_id': run.id,
+                'mimetype': 'application/gzip',
+            }
+            for run, company in zip(runs, results)
+            for name, content in stats[company].payloads
+        ])
+        self.env['account.journal']._eak_invalidate_dashboard()
+        return runs
+
+    @api.autovacuum
+    def _gc_sync_runs(self):
+        days = int(self.env['ir.config_parameter'].sudo().get_param('account_edi_eak.sync_run_retention_days', EAK_SYNC_RUN_RETENTION_DAYS))
+        self.sudo().search([('date_start', '<', fields.Datetime.now() - timedelta(days=days))]).unlink()
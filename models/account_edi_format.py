@@ -1,7 +1,10 @@
 # -*- coding: utf-8 -*-
 # Part of Odoo. See LICENSE file for full copyright and licensing details.
+from functools import partial
 from odoo import models, _
-from .account_edi_eak import EstonianEInvoice
+
+# invoices sent per EInvoice envelope, set by account_edi_eak.invoices_per_envelope
+EAK_INVOICES_PER_ENVELOPE = 1
 
 
 class AccountEdiFormat(models.Model):
@@ -11,47 +14,129 @@ class AccountEdiFormat(models.Model):
         self.ensure_one()
         if self.code == 'EAKs' and invoice._is_eak_invoice():
             return {
-            'post': self._account_edi_eak,
-            'edi_content': self._account_edi_eak_invoice_content,
-        }
+                'post': self._account_edi_eak,
+                # account_edi already groups the jobs by company, _eak_post_walk cuts them in envelopes
+                'post_batching': lambda invoice: (),
+                'edi_content': self._account_edi_eak_invoice_content,
+            }
         return super()._get_move_applicability(invoice)
 
     def _needs_web_services(self):
         # EXTENDS account.edi.format
         return self.code == 'EAKs' or super(AccountEdiFormat, self)._needs_web_services()
 
-    def _account_edi_eak(self, invoice):
-        attachment = ''
-        eAk_response = ''
+    def _get_eak_envelope_size(self):
+        return int(self.env['ir.config_parameter'].sudo().get_param('account_edi_eak.invoices_per_envelope', EAK_INVOICES_PER_ENVELOPE))
+
+    def _account_edi_eak(self, invoices):
+        company = invoices.company_id
+        return company._eak_run_concurrently(lambda company: self._eak_post_walk(invoices), on_error=lambda company, eAk_response: {
+            invoice: {'response': '', **self._invoice_update_vals(eAk_response)} for invoice in invoices
+        })[company]
+
+    def _eak_post_walk(self, invoices):
+        """ Send the valid ``invoices`` in envelopes of account_edi_eak.invoices_per_envelope
+            invoices and map the answers back onto each of them.
+
+            This is a walk for res.company._eak_run_concurrently, returning the account_edi post
+            results: the HTTP call of each envelope is yielded.
+        """
         edi_eak = self.env['account.edi.xml.edi_eak']
-        edi_content ,error = edi_eak._export_invoice(invoice)
-        if not error:
-            eAK =  EstonianEInvoice(invoice.company_id.eak_url)
-            eAk_response = eAK.sendCustomerInvoice(data=edi_content)
-            attachment = self.env['ir.attachment'].create({
-                        'name': edi_eak._export_invoice_filename(invoice),
-                        'raw': edi_content,
-                        'res_model': 'account.move',
-                        'res_id': invoice.id,
-                        'mimetype': 'application/xml'
-                    })
-        else:
-            eAk_response = {'level': 'error', 'fault_code': 'validation', 'fault_string':"\n".join([er for er in error])}
-        invoice.eak_edi_response = eAk_response.get('row')
-        update_vals = self._invoice_update_vals(eAk_response)
-        return {
-            invoice: {
+        errors = self._check_moves_configuration(invoices)
+        responses = {
+            invoice: {'level': 'error', 'fault_code': 'validation', 'fault_string':"\n".join([er for er in error])}
+            for invoice, error in errors.items()
+        }
+        to_send = invoices.filtered(lambda invoice: invoice not in errors)
+        invoices_vals = {invoice: invoice._prepared_eak_invoice(embed_pdf=False) for invoice in to_send}
+        # eAK has the last word, a schema mismatch is only kept in the summary of the invoice
+        schema_warnings = edi_eak._eak_check_schema(invoices_vals)
+
+        attachments_vals = []
+        if to_send:
+            eAK = to_send.company_id._get_eak_client()
+            envelope_size = max(self._get_eak_envelope_size(), 1)
+            for index in range(0, len(to_send), envelope_size):
+                envelope = to_send[index:index + envelope_size]
+                for invoice in envelope:
+                    invoices_vals[invoice]['AttachmentFile'] = invoice._prepared_AttachmentFile_vals(invoices_vals[invoice]['digest'])
+                yield from self._eak_send_envelope(eAK, envelope, invoices_vals, responses)
+                # the invoice PDF is already on the move, the stored envelope does not carry a copy of it
+                attachments_vals += [{
+                            'name': edi_eak._export_invoice_filename(invoice),
+                            'raw': b''.join(edi_eak._export_envelope_stream(invoice, [invoices_vals[invoice]])(embed_pdf=False)),
+                            'res_model': 'account.move',
+                            'res_id': invoice.id,
+                            'mimetype': 'application/xml'
+                        } for invoice in envelope]
+        attachments = self.env['ir.attachment'].create(attachments_vals)
+        attachment_by_invoice = dict(zip(to_send, attachments))
+
+        invoices._eak_store_payloads(
+            {invoice: responses[invoice].get('row') for invoice in invoices},
+            {invoice: "\n".join([responses[invoice].get('fault_string') or _("Received by eAK"), *schema_warnings.get(invoice, [])])
+             for invoice in invoices},
+        )
+        results = {}
+        for invoice in invoices:
+            eAk_response = responses[invoice]
+            results[invoice] = {
                 'response': eAk_response.get('row', ''),
-                'attachment': attachment,
-                **update_vals,
+                'attachment': attachment_by_invoice.get(invoice, ''),
+                **self._invoice_update_vals(eAk_response),
             }
-        }
+        return results
+
+    def _eak_send_envelope(self, eAK, invoices, invoices_vals, responses):
+        """ Send ``invoices`` in one envelope and keep the result eAK gives for each of them, or the
+            answer to the envelope when it gives none. Sending is not idempotent: only the invoices
+            eAK refused are sent again, split in two when the whole envelope was refused, until the
+            faulty invoices are alone in theirs. Transport failures are not sent again, eAK may
+            have received the envelope.
+            This is part of a walk, the HTTP call of each envelope is yielded.
+        """
+        edi_eak = self.env['account.edi.xml.edi_eak']
+        body = edi_eak._export_envelope_stream(invoices, [invoices_vals[invoice] for invoice in invoices])
+        eAk_response = yield partial(eAK.sendCustomerInvoice, data=body)
+        invoice_results = eAk_response.pop('invoices', None) or {}
+        refused = self.env['account.move']
+        for invoice in invoices:
+            responses[invoice] = {**eAk_response, **invoice_results.get(str(invoice.id), {})}
+            if responses[invoice].get('fault_string', ''):
+                refused |= invoice
+        if len(invoices) > 1 and refused and eAk_response.get('fault_code') not in ('server', 'throttled'):
+            if refused == invoices:
+                half = len(invoices) // 2
+                yield from self._eak_send_envelope(eAK, invoices[:half], invoices_vals, responses)
+                yield from self._eak_send_envelope(eAK, invoices[half:], invoices_vals, responses)
+            else:
+                yield from self._eak_send_envelope(eAK, refused, invoices_vals, responses)
 
     def _invoice_update_vals(self, e_invoice):
+        if e_invoice.get('fault_code') == 'throttled':
+            # never sent, the outbox sends it again once eAK takes calls
+            return {'blocking_level': 'warning', 'error': e_invoice.get('fault_string')}
         if e_invoice.get('fault_string', ''):
             return {'blocking_level': 'error', 'error': e_invoice.get('fault_string'),}
         return {'success': True}
 
+    def _check_moves_configuration(self, moves):
+        """ _check_move_configuration for a whole recordset, before anything is rendered: the fields
+            it reads are fetched for all the moves at once.
+
+            :return: {move: errors} for the moves failing the checks
+        """
+        moves.fetch(['partner_id', 'company_id', 'partner_bank_id'])
+        moves.partner_id.fetch(['name', 'company_registry', 'contact_address_complete'])
+        moves.company_id.fetch(['company_registry', 'eak_url', 'eak_auth'])
+        moves.partner_bank_id.fetch(['acc_number'])
+        errors = {}
+        for move in moves:
+            move_errors = self._check_move_configuration(move)
+            if move_errors:
+                errors[move] = move_errors
+        return errors
+
     def _check_move_configuration(self, invoice):
         errors = super()._check_move_configuration(invoice)
         if self.code != 'EAKs':
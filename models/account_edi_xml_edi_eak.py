@@ -1,8 +1,52 @@
 # -*- coding: utf-8 -*-
 # Part of Odoo. See LICENSE file for full copyright and licensing details.
+import os
+import json
+import base64
+import hashlib
+import logging
+import threading
 from lxml import etree
-from odoo import models
+from odoo import models, _
+from odoo.tools.lru import LRU
+from odoo.tools.misc import file_path
 from odoo.tools.xml_utils import cleanup_xml_node
+from .account_move import EAK_FILE_PLACEHOLDER
+from .account_edi_eak_envelope import e_invoice_request
+
+_logger = logging.getLogger(__name__)
+
+# multiple of 3, so that the base64 blocks concatenate without padding
+EAK_BASE64_BLOCK = 3 * 64 * 1024
+# checks of the module on the E_Invoice it writes, not the official schema: account_edi_eak.xsd_path
+# can point to the official e-invoice_ver1.2.xsd instead
+EAK_XSD_PATH = 'account_edi_eak/data/e_invoice_eak_checks.xsd'
+# validated in place of the invoice PDF, not embedded yet
+EAK_XSD_PDF_STANDIN = base64.b64encode(b'%PDF-').decode()
+
+# rendered envelopes kept per process, by database and digest of their values
+EAK_ENVELOPE_CACHE_SIZE = 256
+_envelopes = LRU(EAK_ENVELOPE_CACHE_SIZE)
+
+# {source: (version, schema or None, lock)}, compiled once per process and version of the schema
+_schemas = {}
+_schemas_lock = threading.Lock()
+
+
+def _get_schema(source, version, load):
+    """ The XMLSchema compiled by ``load()`` for ``version`` of ``source``, None when it does not
+        compile. An XMLSchema keeps the errors of its last validation, it comes with a lock.
+    """
+    with _schemas_lock:
+        cached = _schemas.get(source)
+        if cached is None or cached[0] != version:
+            try:
+                schema = etree.XMLSchema(load())
+            except (OSError, etree.XMLSyntaxError, etree.XMLSchemaParseError):
+                _logger.exception("eAK: the e-invoice schema %s could not be compiled, invoices are not validated", source)
+                schema = None
+            cached = _schemas[source] = (version, schema, threading.Lock())
+        return cached[1:]
 
 
 class AccountEdiXmlEDIeAK(models.AbstractModel):
@@ -15,8 +59,89 @@ class AccountEdiXmlEDIeAK(models.AbstractModel):
         return f"{invoice.name.replace('/', '_')}_edi_eak.xml"
 
     def _export_invoice(self, invoice):
-        vals = invoice._prepared_eak_invoice()
-        xml_content = self.env['ir.qweb']._render('account_edi_eak.account_invoice_edi_eak_export', {'vals': vals})
+        body, errors = self._export_invoice_stream(invoice)
+        return body and b''.join(body()), errors
+
+    def _export_invoice_stream(self, invoice):
+        """ Body callable of the envelope of ``invoice`` and the configuration errors, the invoice
+            is not rendered when there are some. A schema mismatch is only logged.
+        """
         edi_format = invoice.journal_id.edi_format_ids.filtered(lambda edi:edi.code == 'EAKs')
-        return etree.tostring(cleanup_xml_node(xml_content, remove_blank_nodes=False), xml_declaration=True, encoding='UTF-8'), edi_format and \
-            edi_format[0]._check_move_configuration(invoice) or False
+        errors = edi_format and edi_format[0]._check_move_configuration(invoice) or False
+        if errors:
+            return False, errors
+        invoice_vals = invoice._prepared_eak_invoice(embed_pdf=False)
+        self._eak_check_schema({invoice: invoice_vals})
+        invoice_vals['AttachmentFile'] = invoice._prepared_AttachmentFile_vals(invoice_vals['digest'])
+        return self._export_envelope_stream(invoice, [invoice_vals]), errors
+
+    def _eak_get_schema(self):
+        """ The compiled e-invoice schema and its lock, (None, None) when it does not compile. """
+        path = self.env['ir.config_parameter'].sudo().get_param('account_edi_eak.xsd_path') or file_path(EAK_XSD_PATH)
+        try:
+            version = os.path.getmtime(path)
+        except OSError:
+            version = None
+        return _get_schema(path, version, lambda: etree.parse(path))
+
+    def _eak_check_schema(self, invoices_vals):
+        """ Validate the E_Invoice of each invoice of ``invoices_vals`` {invoice: values of
+            _prepared_eak_invoice} against the e-invoice schema, before the PDF is embedded. The
+            schema is not the authority on what eAK takes, eAK is: a mismatch is logged and
+            returned as a warning, the invoice is still sent.
+
+            :return: {invoice: readable warnings} for the invoices not matching it
+        """
+        schema, lock = self._eak_get_schema()
+        if schema is None:
+            return {}
+        errors = {}
+        for invoice, invoice_vals in invoices_vals.items():
+            tree = cleanup_xml_node(e_invoice_request({**invoice_vals, 'Footer': invoice._prepared_Footer_vals()}), remove_blank_nodes=False)
+            for file_base64 in tree.iter('FileBase64'):
+                if file_base64.text == EAK_FILE_PLACEHOLDER:
+                    file_base64.text = EAK_XSD_PDF_STANDIN
+            with lock:
+                if schema.validate(next(tree.iter('E_Invoice'))):
+                    continue
+                errors[invoice] = [self._eak_schema_error_message(error) for error in schema.error_log]
+            _logger.warning("eAK: %s does not match the e-invoice schema, sent anyway:\n%s", invoice.name, "\n".join(errors[invoice]))
+        return errors
+
+    def _eak_schema_error_message(self, error):
+        # "Element 'RegNumber': [facet 'pattern'] The value ..." at /E_Invoice/Invoice/.../RegNumber
+        message = error.message.split(': ', 1)[-1] if error.message.startswith('Element ') else error.message
+        path = " > ".join(step for step in (error.path or '').split('/')[2:] if step)
+        return _("e-invoice schema, %(path)s: %(message)s", path=path or 'E_Invoice', message=message)
+
+    def _export_envelope_stream(self, invoices, invoices_vals):
+        """ Render one envelope holding ``invoices`` (whose _prepared_eak_invoice values are
+            ``invoices_vals``) around a placeholder for each invoice PDF and return a callable
+            producing the request body chunk by chunk: the PDFs are base64-encoded in fixed-size
+            blocks read from the files, so that the memory used by a send does not depend on their
+            size. With ``embed_pdf=False`` the callable leaves FileBase64 empty.
+        """
+        # rendered once per version of everything it holds, the PDFs aside: the send and the stored copy share it
+        footer = invoices._prepared_Footer_vals()
+        rendered = [footer] + [
+            {**invoice_vals, 'AttachmentFile': {key: value for key, value in invoice_vals['AttachmentFile'].items() if key != 'open'}}
+            for invoice_vals in invoices_vals
+        ]
+        key = (self.env.cr.dbname, hashlib.sha1(json.dumps(rendered, sort_keys=True, default=str).encode()).hexdigest())
+        envelope = _envelopes.get(key)
+        if envelope is None:
+            tree = e_invoice_request({**invoices_vals[0], 'Footer': footer}, invoices_vals)
+            envelope = _envelopes[key] = etree.tostring(cleanup_xml_node(tree, remove_blank_nodes=False), xml_declaration=True, encoding='UTF-8')
+        *parts, tail = envelope.split(EAK_FILE_PLACEHOLDER.encode())
+        open_pdfs = [invoice_vals['AttachmentFile']['open'] for invoice_vals in invoices_vals]
+
+        def body(embed_pdf=True):
+            for part, open_pdf in zip(parts, open_pdfs):
+                yield part
+                if embed_pdf:
+                    with open_pdf() as pdf:
+                        while block := pdf.read(EAK_BASE64_BLOCK):
+                            yield base64.b64encode(block)
+            yield tail
+
+        return body
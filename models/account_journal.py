@@ -1,66 +1,373 @@
 # -*- coding: utf-8 -*-
 # Part of Odoo. See LICENSE file for full copyright and licensing details.
-from lxml import etree
+import time
+import logging
+import threading
+from datetime import timedelta
+from functools import partial
 from odoo.exceptions import UserError
+from odoo.tools.misc import format_datetime
 from odoo import models, fields, Command, _
-from .account_edi_eak import EstonianEInvoice
+from .account_edi_eak_envelope import buy_invoice_export_request
+from .account_edi_eak_sync_run import EakSyncStats
+from .res_company import EAK_COMMIT
+
+_logger = logging.getLogger(__name__)
+# eAK returns at most this many bills per BuyInvoiceExportRequest
+EAK_EXPORT_CAP = 100
+# export window sizes, in minutes
+EAK_DEFAULT_WINDOW = 24 * 60
+EAK_MIN_WINDOW = 1
+EAK_MAX_WINDOW = 31 * 24 * 60
+EAK_MAX_WINDOWS = 50
+# new vendor bills created per savepoint and commit
+EAK_BILL_CHUNK_SIZE = 20
+# seconds the eAK counters of a journal dashboard card are kept, per process
+EAK_DASHBOARD_TTL = 60
+
+
+
+def _eak_number(value):
+    """ An optional number of an export record: None when empty, ValueError when not a number. """
+    value = str(value if value is not None else '').strip()
+    return float(value) if value else None
+
+
+# {(dbname, journal id): (expiry, counters)}
+_dashboard_cache = {}
+_dashboard_cache_lock = threading.Lock()
+
 
 
 class AccountJournal(models.Model):
     _inherit = "account.journal"
 
     def _cron_fetch_eak_vendor_bill(self):
-        logger = []
-        eAk_response= {}
-        cron_name = 'eAk: Sync Vendor Bills'
         companies = self.env['res.company']._get_companies()
-        for company in companies:
-            eAk_obj = EstonianEInvoice(company.eak_url)
-            eAk_response = self.process_eak_vendor_bill(eAk_obj, company)
-            message = f"\n {company.name} Successfully Run Schedule Action\n {eAk_response.get('fault_string', '')}"
-            eAk_response.update({'message': message})
-            logger.append(self._prepare_logger_values(cron_name, company.eak_url, eAk_response))
-            self.env.cr.commit()
         if not companies:
-            eAk_response.update({'message' : "Please add eAk auth token/eAk URL"})
-            logger.append(self._prepare_logger_values(cron_name, 'Empty auth/Url', eAk_response))
-        self.env['ir.logging'].sudo().create(logger)
+            _logger.info("eAk: Sync Vendor Bills: Please add eAk auth token/eAk URL")
+            return
+        companies = companies._eak_ready_companies('account_edi_eak.ir_cron_fetch_eak_bills')
+        sync_run = self.env['account.edi.eak.sync.run']
+        stats = sync_run._new_stats(companies)
+        results = companies._eak_run_concurrently(
+            lambda company: self._eak_fetch_vendor_bill_windows(company._get_eak_client(), company, stats=stats[company]),
+            commit=True)
+        sync_run._create_runs('vendor_bills', {company: (eAk_response, False) for company, eAk_response in results.items()}, stats)
+
+    def _fill_sale_purchase_dashboard_data(self, dashboard_data):
+        # EXTENDS account
+        super()._fill_sale_purchase_dashboard_data(dashboard_data)
+        journals = self.filtered(lambda journal: journal.type in ('sale', 'purchase')
+                                 and journal.company_id.eak_url and journal.company_id.eak_auth)
+        for journal_id, counters in journals._eak_dashboard_counters().items():
+            dashboard_data[journal_id].update({
+                **counters,
+                'eak_dashboard': True,
+                'eak_last_sync': counters['eak_last_sync'] and format_datetime(self.env, counters['eak_last_sync']),
+                'eak_last_sync_duration': round(counters['eak_last_sync_duration']),
+            })
+
+    def _eak_dashboard_counters(self):
+        """ The eAK counters of the dashboard cards of ``self``, kept account_edi_eak.dashboard_ttl
+            seconds per process: opening the dashboard does not count the moves again each time.
+
+            :return: {journal id: counters}
+        """
+        ttl = float(self.env['ir.config_parameter'].sudo().get_param('account_edi_eak.dashboard_ttl', EAK_DASHBOARD_TTL))
+        dbname = self.env.cr.dbname
+        now = time.monotonic()
+        with _dashboard_cache_lock:
+            cached = {journal_id: _dashboard_cache.get((dbname, journal_id)) for journal_id in self.ids}
+        counters = {journal_id: entry[1] for journal_id, entry in cached.items() if entry and entry[0] > now}
+        missing = self.browse([journal_id for journal_id in self.ids if journal_id not in counters])
+        if missing:
+            computed = missing._eak_compute_dashboard_counters()
+            with _dashboard_cache_lock:
+                for journal_id, journal_counters in computed.items():
+                    _dashboard_cache[dbname, journal_id] = (now + ttl, journal_counters)
+            counters.update(computed)
+        return counters
+
+    def _eak_compute_dashboard_counters(self):
+        """ Count, with one grouped query each, the eAK vendor bills whose attachment is not fetched
+            yet per purchase journal, the eAK invoices waiting in the outbox and the failed ones per
+            sale journal, and find the last successful vendor bill sync of each company.
+        """
+        counters = {journal.id: {
+            'eak_bills_without_attachment': 0,
+            'eak_invoices_pending': 0,
+            'eak_invoices_failed': 0,
+            'eak_last_sync': False,
+            'eak_last_sync_duration': 0,
+        } for journal in self}
+        purchase = self.filtered(lambda journal: journal.type == 'purchase')
+        sale = self.filtered(lambda journal: journal.type == 'sale')
+        if purchase:
+            for journal, count in self.env['account.move'].sudo()._read_group(
+                    [('journal_id', 'in', purchase.ids), ('eak_edi_bill', '=', True), ('eak_edi_bill_attachment', '=', False)],
+                    ['journal_id'], ['__count']):
+                counters[journal.id]['eak_bills_without_attachment'] = count
+            self.env.cr.execute("""
+                SELECT DISTINCT ON (company_id) company_id, date_end, EXTRACT(EPOCH FROM date_end - date_start)
+                  FROM account_edi_eak_sync_run
+                 WHERE job = 'vendor_bills' AND state = 'success' AND company_id IN %s
+              ORDER BY company_id, date_end DESC
+            """, [tuple(purchase.company_id.ids)])
+            last_syncs = {company_id: (date_end, duration) for company_id, date_end, duration in self.env.cr.fetchall()}
+            for journal in purchase:
+                date_end, duration = last_syncs.get(journal.company_id.id, (False, 0))
+                counters[journal.id].update({'eak_last_sync': date_end, 'eak_last_sync_duration': float(duration or 0)})
+        if sale:
+            self.env.cr.execute("""
+                SELECT move.journal_id, COALESCE(document.blocking_level = 'error', FALSE), COUNT(*)
+                  FROM account_edi_document document
+                  JOIN account_edi_format edi_format ON edi_format.id = document.edi_format_id
+                  JOIN account_move move ON move.id = document.move_id
+                 WHERE edi_format.code = 'EAKs' AND document.state = 'to_send' AND move.journal_id IN %s
+              GROUP BY 1, 2
+            """, [tuple(sale.ids)])
+            for journal_id, failed, count in self.env.cr.fetchall():
+                counters[journal_id]['eak_invoices_failed' if failed else 'eak_invoices_pending'] = count
+        return counters
+
+    def _eak_invalidate_dashboard(self):
+        """ Forget the eAK counters of this process, they changed. """
+        dbname = self.env.cr.dbname
+        with _dashboard_cache_lock:
+            for key in [key for key in _dashboard_cache if key[0] == dbname]:
+                del _dashboard_cache[key]
 
-    def process_eak_vendor_bill(self, eAk_obj=False, company_id=False):
+    def action_open_eak_moves(self):
+        """ Dashboard counters: the moves of the journal behind the counter of the context key eak_kpi. """
+        self.ensure_one()
+        domain = {
+            'attachments': [('eak_edi_bill', '=', True), ('eak_edi_bill_attachment', '=', False)],
+            'pending': [('edi_document_ids', 'any', [('edi_format_id.code', '=', 'EAKs'), ('state', '=', 'to_send'),
+                                                     ('blocking_level', '!=', 'error')])],
+            'failed': [('edi_document_ids', 'any', [('edi_format_id.code', '=', 'EAKs'), ('state', '=', 'to_send'),
+                                                    ('blocking_level', '=', 'error')])],
+        }[self.env.context.get('eak_kpi')]
+        return {
+            'type': 'ir.actions.act_window',
+            'name': self.name,
+            'res_model': 'account.move',
+            'view_mode': 'tree,form',
+            'domain': [('journal_id', '=', self.id)] + domain,
+            'context': {'default_journal_id': self.id},
+        }
+
+    def action_fetch_eak_vendor_bill(self):
+        """ Dashboard button: fetch the vendor bills of the current company now, unless a sync of
+            the vendor bills already runs. The row of the cron is locked for the fetch, as the cron
+            runner does while the cron runs, so clicks do not pile up export requests on eAK.
+        """
+        cron = self.env.ref('account_edi_eak.ir_cron_fetch_eak_bills')
+        self.env.cr.execute('SELECT id FROM ir_cron WHERE id = %s FOR NO KEY UPDATE SKIP LOCKED', [cron.id])
+        if not self.env.cr.fetchone():
+            return {
+                'type': 'ir.actions.client',
+                'tag': 'display_notification',
+                'params': {
+                    'title': _('Vendor Bills'),
+                    'type': 'warning',
+                    'message': _("The vendor bills are being fetched from eAK already, please try again later."),
+                    'sticky': False,
+                }
+            }
+        action = self.with_context(sticky_notifications=True).process_eak_vendor_bill()
+        self._eak_invalidate_dashboard()
+        return action
+
+    def process_eak_vendor_bill(self, eAk_obj=False, company_id=False, commit=False):
         if not company_id:
             company_id = self.env.company
-            eAk_obj = EstonianEInvoice(company_id.eak_url)
-        eak_auth, eAk_response = company_id._get_eak_auth()
-        if eak_auth:
-            vals = {
-                'authPhrase': eak_auth, 
-                'from_date': company_id.eak_bill_export_date
-            }
-            edi_content = self.env['ir.qweb']._render('account_edi_eak.account_invoice_edi_eak_import',{'vals': vals})
-            eAk_response = eAk_obj.getVendorBills(edi_content)
-            if eAk_response.get('level') != 'error':
-                eAk_response, error = self._process_eak_vendor_bill(eAk_response)
-                if not error:
-                    eAk_response.update({'level': 'success'})
-                    company_id.eak_bill_export_date = fields.datetime.now()
-                else:
-                    eAk_response.update({'error_type': 'info'})
+            eAk_obj = company_id._get_eak_client()
+        eAk_response = company_id._eak_run_concurrently(
+            lambda company: self._eak_fetch_vendor_bill_windows(eAk_obj, company), commit=commit)[company_id]
         if self.env.context.get('sticky_notifications'):
             return self._vendor_bill_notifications(eAk_response)
         return eAk_response
 
-    def _process_eak_vendor_bill(self, eAk_response):
-        if eAk_response.get('row'):
-            row = etree.XML(eAk_response.get('row'))
-            invoices = ''
-            invoices_vals = ''
-            invoices_vals, error = self._prepared_import_eak_invoice(row)
-            if not error and not eAk_response.get('fault_string', '') :
-                invoices = self.env['account.move'].sudo().create(invoices_vals)
-            if error:
-                error_message = "\n".join([er for er in error])
-                eAk_response.update({'level': 'error', 'fault_string': error_message, 'error_type': 'danger', 'error_raise': True})
-        return eAk_response, False if invoices_vals and invoices else True
+    def _eak_vendor_bill_request(self, company, since, till):
+        vals = {
+            'authPhrase': company.eak_auth,
+            'from_date': since,
+            'to_date': till,
+        }
+        return buy_invoice_export_request(vals)
+
+    def _eak_fetch_vendor_bill_windows(self, eAk_obj, company, stats=None):
+        """ Walk the time range from the company checkpoint up to now in windows. eAK caps each
+            answer at EAK_EXPORT_CAP bills: a window hitting the cap is fetched again at half the
+            size, a sparse one makes the next window twice as large. The checkpoint only moves to
+            the end of a window once each of its bills is committed or quarantined, the learned
+            window size is kept on the company and
+            at most account_edi_eak.max_export_windows windows are fetched per call, so a long
+            backfill resumes on the next run where it stopped.
+
+            This is a walk for res.company._eak_run_concurrently: the HTTP call of each window is
+            yielded and its response sent back, EAK_COMMIT is yielded after each chunk of bills
+            and once a window is done.
+            ``stats`` (EakSyncStats) collects the phase timings.
+        """
+        stats = stats or EakSyncStats()
+        eak_auth, eAk_response = company._get_eak_auth()
+        if not eak_auth:
+            return eAk_response
+        max_windows = int(self.env['ir.config_parameter'].sudo().get_param('account_edi_eak.max_export_windows', EAK_MAX_WINDOWS))
+        min_window = timedelta(minutes=EAK_MIN_WINDOW)
+        max_window = timedelta(minutes=EAK_MAX_WINDOW)
+        window = timedelta(minutes=company.eak_bill_export_window or EAK_DEFAULT_WINDOW)
+        since = company.eak_bill_export_date
+        until = fields.Datetime.now()
+        eAk_response = {'level': 'success', 'row': ''}
+        summary = []
+        windows = 0
+        while since < until and windows < max_windows:
+            windows += 1
+            till = min(since + window, until)
+            with stats.phase('build'):
+                request = self._eak_vendor_bill_request(company, since, till)
+            stats.payload(f'BuyInvoiceExportRequest {since} {till}', request)
+            eAk_response = yield partial(eAk_obj.getVendorBills, request)
+            stats.add_response(eAk_response)
+            if stats.store_payloads:
+                stats.payload(f'BuyInvoiceExportResponse {since} {till}',
+                              "\n".join(record['raw']() for record in eAk_response.get('records', [])))
+            if eAk_response.get('level') == 'error':
+                break
+            count = len(eAk_response.get('records', []))
+            if count >= EAK_EXPORT_CAP and window > min_window:
+                window = max(window / 2, min_window)
+                continue
+            if count >= EAK_EXPORT_CAP:
+                _logger.warning("eAK export of %s from %s to %s hit the cap of %s bills at the minimum window size",
+                                company.name, since, till, EAK_EXPORT_CAP)
+            eAk_response = yield from self._eak_import_vendor_bills(eAk_response, stats)
+            summary.append(f"{since} - {till}: {eAk_response.get('row', '')}")
+            if count < EAK_EXPORT_CAP // 4:
+                window = min(window * 2, max_window)
+            company.write({
+                'eak_bill_export_date': till,
+                'eak_bill_export_window': int(window.total_seconds() // 60),
+            })
+            with stats.phase('commit'):
+                yield EAK_COMMIT
+            since = till
+        else:
+            eAk_response.update({'level': 'success'})
+        eAk_response['row'] = "\n".join(summary)
+        return eAk_response
+
+    def _process_eak_vendor_bill(self, eAk_response, stats=None):
+        """ Import the bills of an export response in the current transaction, see
+            _eak_import_vendor_bills.
+        """
+        steps = self._eak_import_vendor_bills(eAk_response, stats)
+        while True:
+            try:
+                next(steps)
+            except StopIteration as stop:
+                return stop.value
+
+    def _eak_import_vendor_bills(self, eAk_response, stats=None):
+        """ Import the bills of an export response: known bills are upserted, new ones are created
+            by chunks of account_edi_eak.bill_chunk_size bills, each under a savepoint. A bill whose
+            master data is not found or whose creation fails is quarantined with its reasons, the
+            others are imported.
+
+            This is part of a walk, EAK_COMMIT is yielded after each chunk: the bills are upserted
+            on their key, a window imported again after a partial commit only creates the others.
+        """
+        stats = stats or EakSyncStats()
+        if not eAk_response.get('records') or eAk_response.get('fault_string', ''):
+            return eAk_response
+        with stats.phase('resolve'):
+            new_records, updated, skipped = self._eak_sync_known_vendor_bills(eAk_response['records'])
+            invoices_vals, rejected = self._prepared_import_eak_invoice(new_records)
+        quarantine = self.env['account.edi.eak.bill.quarantine']
+        rejected_records = [(new_records[index], reasons) for index, reasons in rejected.items()]
+        accepted = [record for index, record in enumerate(new_records) if index not in rejected]
+        chunk_size = int(self.env['ir.config_parameter'].sudo().get_param('account_edi_eak.bill_chunk_size', EAK_BILL_CHUNK_SIZE))
+        created = 0
+        for start in range(0, len(invoices_vals), chunk_size):
+            records = accepted[start:start + chunk_size]
+            with stats.phase('create'):
+                moves, failed = self._eak_create_vendor_bills(invoices_vals[start:start + chunk_size])
+                quarantine._release([record for index, record in enumerate(records) if index not in failed])
+                self.env['account.move']._eak_store_payloads(
+                    {move: records[index]['raw']() for index, move in moves.items()},
+                    {move: move.eak_edi_state for move in moves.values()})
+            rejected_records += [(records[index], [reason]) for index, reason in failed.items()]
+            created += len(moves)
+            with stats.phase('commit'):
+                yield EAK_COMMIT
+        if rejected_records:
+            with stats.phase('create'):
+                quarantine._quarantine(rejected_records)
+        stats.count(received=len(eAk_response['records']), created=created, updated=updated, unchanged=skipped)
+        eAk_response['row'] = f"{created} created, {updated} updated, {skipped} unchanged"
+        if rejected_records:
+            eAk_response['row'] += f", {len(rejected_records)} quarantined"
+        return eAk_response
+
+    def _eak_create_vendor_bills(self, invoices_vals):
+        """ Create the bills of ``invoices_vals`` under one savepoint, or one savepoint per bill
+            when the chunk fails.
+
+            :return: the bill created and the reason of each bill not created, per index in
+                     ``invoices_vals``
+        """
+        moves = self.env['account.move'].sudo()
+        try:
+            with self.env.cr.savepoint():
+                return dict(enumerate(moves.create(invoices_vals))), {}
+        except Exception:
+            pass
+        created, failed = {}, {}
+        for index, vals in enumerate(invoices_vals):
+            try:
+                with self.env.cr.savepoint():
+                    created[index] = moves.create([vals])
+            except Exception as e:
+                failed[index] = str(e)
+        return created, failed
+
+    def _eak_sync_known_vendor_bills(self, records):
+        """ Upsert step of the import: bills already imported for the same company are matched on
+            their eak_edi_bill_id. Their eAK state and response are updated when the content digest
+            changed, and they are skipped otherwise.
+
+            :return: the records of bills still to create, the count of updated and unchanged bills
+        """
+        # the same bill can be returned more than once when export windows overlap, keep the latest
+        by_key = {(record['regNumber'], record['invoiceId']): record for record in records}
+        domain = [
+            ('eak_edi_bill_id', 'in', list({bill_id for _reg, bill_id in by_key})),
+            ('company_id.company_registry', 'in', list({reg for reg, _bill_id in by_key})),
+        ]
+        existing = {}
+        for move in self.env['account.move'].sudo().search_fetch(domain, ['company_id', 'eak_edi_bill_id', 'eak_edi_digest']):
+            existing.setdefault((move.company_id.company_registry, move.eak_edi_bill_id), move)
+        updated = skipped = 0
+        new_records = []
+        payloads = {}
+        for key, record in by_key.items():
+            move = existing.get(key)
+            if not move:
+                new_records.append(record)
+            elif move.eak_edi_digest == record['digest']:
+                skipped += 1
+            else:
+                move.write({
+                    'eak_edi_state': record['state'],
+                    'eak_edi_digest': record['digest'],
+                })
+                payloads[move] = record['raw']()
+                updated += 1
+        self.env['account.move']._eak_store_payloads(payloads, {move: move.eak_edi_state for move in payloads})
+        return new_records, updated, skipped
 
     def _vendor_bill_notifications(self, eAk_response):
         error_type = eAk_response.get('error_type')
@@ -79,29 +386,80 @@ class AccountJournal(models.Model):
             }
         }
 
-    def _prepared_import_eak_invoice(self, response):
-        error = []
-        inner_errors = []
-        tax = self.env['account.tax']
-        partner = self.env['res.partner']
-        company = self.env['res.company']
-        currency = self.env['res.currency']
-        product = self.env['product.product']
-        partner_bank = self.env['res.partner.bank']
-        unmatched_product_id = self.env.ref('account_edi_eak.unmatched_product_account_edi_eak').id
+    def _eak_resolve_master_data(self, records):
+        """ Resolve every company, currency, partner, product, tax and bank account referenced by
+            the export records with one grouped query per kind.
+            Partners, products and taxes are mapped per company id.
+        """
+        companies = {}
+        company_domain = [('company_registry', 'in', list({invoice['regNumber'] for invoice in records} - {''}))]
+        for company in self.env['res.company'].sudo().search_fetch(company_domain, ['company_registry']):
+            companies.setdefault(company.company_registry, company.id)
 
-        def _find_id(obj, domain):
-            _id = obj.sudo().search(domain, limit=1)
-            return _id and _id.id or ''
+        currencies = {}
+        currency_domain = [('name', 'in', list({invoice['Currency'] for invoice in records}))]
+        for currency in self.env['res.currency'].sudo().search_fetch(currency_domain, ['name']):
+            currencies.setdefault(currency.name, currency.id)
 
-        def _find_with_company_id(obj, company, domain):
-            _id = obj.with_company(company).search(domain, limit=1)
-            return _id and _id.id or ''
+        partner_bank = {}
+        bank_domain = [('acc_number', 'in', list({invoice['PayToAccount'] for invoice in records} - {''}))]
+        for bank in self.env['res.partner.bank'].sudo().search_fetch(bank_domain, ['acc_number']):
+            partner_bank.setdefault(bank.acc_number, bank.id)
+
+        reg_numbers, default_codes, rates = set(), set(), set()
+        for invoice in records:
+            if invoice['regNumber'] in companies:
+                reg_numbers.add(invoice['SellerRegNumber'])
+                for line in invoice['lines']:
+                    default_codes.add(line['InformationContent'])
+                    # the invalid rates are reported per bill by _prepared_import_eak_invoice
+                    try:
+                        rates.add(_eak_number(line['VATRate']))
+                    except ValueError:
+                        pass
+        rates.discard(None)
+        company_ids = list(set(companies.values()))
+        partners = {company_id: {} for company_id in company_ids}
+        products = {company_id: {} for company_id in company_ids}
+        taxes = {company_id: {} for company_id in company_ids}
+
+        def _map_per_company(found, key, target):
+            # records without company are shared by every company, like the multi-company rules do
+            for record in found:
+                for company_id in ([record.company_id.id] if record.company_id else company_ids):
+                    if company_id in target:
+                        target[company_id].setdefault(record[key], record.id)
+
+        partner_domain = [('company_registry', 'in', list(reg_numbers - {''})), ('company_id', 'in', [False] + company_ids)]
+        _map_per_company(self.env['res.partner'].sudo().search_fetch(partner_domain, ['company_registry', 'company_id']),
+                         'company_registry', partners)
+        product_domain = [('default_code', 'in', list(default_codes - {''})), ('company_id', 'in', [False] + company_ids)]
+        _map_per_company(self.env['product.product'].sudo().search_fetch(product_domain, ['default_code', 'company_id']),
+                         'default_code', products)
+        tax_domain = [('type_tax_use', '=', 'purchase'), ('amount', 'in', list(rates)), ('company_id', 'in', company_ids)]
+        _map_per_company(self.env['account.tax'].sudo().search_fetch(tax_domain, ['amount', 'company_id']),
+                         'amount', taxes)
+        return {
+            'company': companies,
+            'currency': currencies,
+            'partner_bank': partner_bank,
+            'partner': partners,
+            'product': products,
+            'tax': taxes,
+        }
+
+    def _prepared_import_eak_invoice(self, records):
+        """ :return: the vals of the bills to create and, per index in ``records``, the reasons of
+            the bills whose master data is not found
+        """
+        error = []
+        rejected = {}
+        master_data = self._eak_resolve_master_data(records)
+        unmatched_product_id = self.env.ref('account_edi_eak.unmatched_product_account_edi_eak').id
 
         def _prepared_InvoiceParties_vals(invoice):
-            partner_RegNumber = invoice.findtext('.//InvoiceParties/SellerParty/RegNumber', '')
-            partner_domain = [('company_registry', '=', partner_RegNumber)]
-            partner_id = _find_with_company_id(partner, company_id, partner_domain)
+            partner_RegNumber = invoice['SellerRegNumber']
+            partner_id = master_data['partner'][company_id].get(partner_RegNumber, '')
             if not partner_id:
                 error.append(_(f"- Partner Company ID: {partner_RegNumber}"))
             return {
@@ -110,9 +468,9 @@ class AccountJournal(models.Model):
 
         def _prepared_InvoiceInformation_vals(invoice):
             return {
-                'ref': invoice.findtext('.//InvoiceInformation/InvoiceNumber', ''),
-                'invoice_date': invoice.findtext('.//InvoiceInformation/InvoiceDate', ''),
-                'invoice_date_due': invoice.findtext('.//InvoiceInformation/DueDate', '')
+                'ref': invoice['InvoiceNumber'],
+                'invoice_date': invoice['InvoiceDate'],
+                'invoice_date_due': invoice['DueDate']
             }
 
         def _prepared_InvoiceSumGroup_vals(invoice):
@@ -122,82 +480,71 @@ class AccountJournal(models.Model):
         def _prepared_InvoiceItem_vals(lines):
             line_list = []
             for line in lines:
-                VATRate = line.findtext('.//VAT/VATRate', '')
-                product_default_code = line.findtext('.//ItemReserve/InformationContent', '')
-                product_domain = [('default_code', '=', product_default_code), ('default_code', '!=', '')]
-                product_id = _find_with_company_id(product, company_id, product_domain)
-                tax_domain = [('type_tax_use', '=', 'purchase'), ('amount', '=', float(VATRate)), ('company_id', '=', company_id)]
-                tax_id = _find_id(tax, tax_domain)
-                if not tax_id:
+                VATRate = line['VATRate']
+                product_default_code = line['InformationContent']
+                product_id = master_data['product'][company_id].get(product_default_code, '')
+                try:
+                    rate, discount = _eak_number(VATRate), _eak_number(line['AddRate']) or 0.0
+                except ValueError:
+                    error.append(_(f"- Tax Amount: {VATRate}%, Discount: {line['AddRate']}%"))
+                    continue
+                # an item without VAT gets no tax
+                tax_id = rate is not None and master_data['tax'][company_id].get(rate, '')
+                if tax_id == '':
                     error.append(_(f"- Tax Amount: {VATRate}%"))
-                #Find Line Discount Value
-                discount = 0
-                for add in line.findall('.//Addition'):
-                    if add.attrib['addCode'] == 'DSC':
-                        discount = float(add.findtext('AddRate', 0))
                 line_vals = {
                     'product_id' :product_id or unmatched_product_id,
-                    'tax_ids': [tax_id],
-                    'quantity': line.findtext('.//ItemAmount', ''),
-                    'price_unit': line.findtext('.//ItemPrice', ''),
-                    'price_subtotal': line.findtext('.//ItemSum', ''),
-                    'price_total': line.findtext('.//ItemTotal', ''),
+                    'tax_ids': [tax_id] if tax_id else [Command.clear()],
+                    'quantity': line['ItemAmount'],
+                    'price_unit': line['ItemPrice'],
+                    'price_subtotal': line['ItemSum'],
+                    'price_total': line['ItemTotal'],
                     'discount': discount,
                 }
                 if not product_id:
-                    product_name = line.findtext('.//Description', '')
+                    product_name = line['Description']
                     line_vals.update({'name': f'{product_default_code} - {product_name}'})
                 line_list.append(Command.create(line_vals))
             return line_list
 
         def _prepared_PaymentInfo_vals(invoice):
-            partner_bank_domain= [('acc_number', '=', invoice.findtext('.//PaymentInfo/PayToAccount', '')), ('acc_number', '!=', '')]
             return {
-                'partner_bank_id': _find_id(partner_bank, partner_bank_domain),
-                'payment_reference' : invoice.findtext('.//PaymentInfo/PaymentDescription', '')
+                'partner_bank_id': master_data['partner_bank'].get(invoice['PayToAccount'], ''),
+                'payment_reference' : invoice['PaymentDescription']
             }
 
         vendor_bills = []
-        for invoice in response.findall('.//Invoice'):
-            company_regNumber = invoice.attrib['regNumber']
-            company_id = _find_id(company, [('company_registry', '=', company_regNumber), ('company_registry', '!=', '')])
-            currency_code = invoice.findtext('.//InvoiceSumGroup/Currency', '')
-            currency_id =_find_id(currency, [('name', '=', currency_code)])
-            if not company_id:
-                error.append(_(f"* Company ID: {company_regNumber} Not Found"))
-            if not currency_id:
-                error.append(_(f"* Currency Code: {currency_code} Not active"))
-            if company_id and currency_id:
-                error=[]
-                vendor_vals = {
-                    'eak_edi_bill': True,
-                    'move_type': 'in_invoice',
-                    'company_id': company_id,
-                    'currency_id': currency_id,
-                    'eak_edi_bill_id': invoice.attrib['invoiceId'],
-                    **_prepared_InvoiceParties_vals(invoice),
-                    **_prepared_InvoiceInformation_vals(invoice),
-                    **_prepared_InvoiceSumGroup_vals(invoice),
-                    **_prepared_PaymentInfo_vals(invoice),
-                    'eak_edi_response': etree.tostring(invoice, encoding='unicode', pretty_print=True),
-                    'invoice_line_ids': _prepared_InvoiceItem_vals(invoice.findall('.//InvoiceItem/InvoiceItemGroup/ItemEntry')),
-                }
-                if error:
-                    error.insert(0, (_(f"Company ID: {company_regNumber} Not Founded")))
-                    inner_errors += error
-                vendor_bills.append(vendor_vals)
-        return vendor_bills, inner_errors or error
-
-    def _prepare_logger_values(self, name, eak_url, eAk_response, method="POST"):
-        error = eAk_response.get('level') != 'success'
-        defaults = {
-            'name': name,
-            'type': 'server',
-            'dbname': self._cr.dbname,
-            'level': 'ERROR' if error else 'INFO',
-            'path': eak_url,
-            'func': method,
-            'line': '1',
-            'message': eAk_response.get('message') if error else eAk_response.get('row')
-        }
-        return defaults
+        for index, invoice in enumerate(records):
+            error = []
+            # a malformed bill is quarantined, the others are imported
+            try:
+                company_regNumber = invoice['regNumber']
+                company_id = master_data['company'].get(company_regNumber, '')
+                currency_code = invoice['Currency']
+                currency_id = master_data['currency'].get(currency_code, '')
+                if not company_id:
+                    error.append(_(f"* Company ID: {company_regNumber} Not Found"))
+                if not currency_id:
+                    error.append(_(f"* Currency Code: {currency_code} Not active"))
+                if company_id and currency_id:
+                    vendor_vals = {
+                        'eak_edi_bill': True,
+                        'move_type': 'in_invoice',
+                        'company_id': company_id,
+                        'currency_id': currency_id,
+                        'eak_edi_bill_id': invoice['invoiceId'],
+                        'eak_edi_state': invoice['state'],
+                        'eak_edi_digest': invoice['digest'],
+                        **_prepared_InvoiceParties_vals(invoice),
+                        **_prepared_InvoiceInformation_vals(invoice),
+                        **_prepared_InvoiceSumGroup_vals(invoice),
+                        **_prepared_PaymentInfo_vals(invoice),
+                        'invoice_line_ids': _prepared_InvoiceItem_vals(invoice['lines']),
+                    }
+                    if not error:
+                        vendor_bills.append(vendor_vals)
+            except (KeyError, TypeError, ValueError) as e:
+                error.append(_("* Invalid eAK bill: %s", e))
+            if error:
+                rejected[index] = error
+        return vendor_bills, rejected
@@ -1,25 +1,130 @@
 # -*- coding: utf-8 -*-
 # Part of Odoo. See LICENSE file for full copyright and licensing details.
-import binascii
-from lxml import etree
+import io
+import gzip
+import json
+import hashlib
+from functools import partial
 from datetime import datetime
 from odoo.tools import float_repr
-from odoo import fields, models, _
-from .account_edi_eak import EstonianEInvoice
+from odoo.tools.sql import create_index
+from odoo import api, fields, models, _
+from .account_edi_eak_envelope import invoice_attachment_request
+from .account_edi_eak_sync_run import EakSyncStats
+from .res_company import EAK_COMMIT
 
 DEFAULT_eAK_DATE_FORMAT = '%Y-%m-%d'
+EAK_ATTACHMENT_AVERAGE_BYTES = 256 * 1024
+EAK_ATTACHMENT_BATCH_BYTES = 20 * 1024 * 1024
+EAK_ATTACHMENT_RUN_BYTES = 1024 * 1024 * 1024
+EAK_ATTACHMENT_MAX_BATCH = 100
+# stands for the PDF in the rendered envelope, the export streams the encoded file in its place
+EAK_FILE_PLACEHOLDER = '___EAK_FILE_BASE64___'
+# description of the invoice PDFs rendered for eAK, followed by the digest of the report inputs
+EAK_PDF_CACHE_PREFIX = 'eAK PDF '
+# name of the gzip attachment holding the raw eAK XML of a move
+EAK_PAYLOAD_NAME = 'eak_response.xml.gz'
+EAK_SUMMARY_SIZE = 200
 
 class AccountMove(models.Model):
     _inherit = 'account.move'
 
-    eak_edi_response = fields.Text('EAk Response', readonly=True, copy=False)
+    eak_edi_payload_id = fields.Many2one('ir.attachment', 'eAK Payload', readonly=True, copy=False)
+    eak_invoice_pdf_id = fields.Many2one('ir.attachment', 'eAK Invoice PDF', readonly=True, copy=False)
+    eak_edi_summary = fields.Char('eAK Response Summary', readonly=True, copy=False)
     eak_edi_bill = fields.Boolean(string='eAK Vendor Bill', readonly=True, copy=False)
     eak_edi_bill_id = fields.Char('eAK Bill Number', readonly=True, copy=False)
     eak_edi_bill_attachment = fields.Boolean(string='Vendor Bill Attachment Processed', readonly=True, copy=False)
+    eak_edi_state = fields.Char('eAK State', readonly=True, copy=False)
+    eak_edi_digest = fields.Char('eAK Content Digest', readonly=True, copy=False)
+    eak_outbox_state = fields.Selection([
+        ('queued', "Queued"),
+        ('retrying', "Queued, Retrying"),
+        ('failed', "Failed"),
+        ('sent', "Sent"),
+    ], string='eAK Outbox', compute='_compute_eak_outbox_state')
+
+    def init(self):
+        super().init()
+        create_index(self._cr, 'account_move_company_eak_edi_bill_id_index', self._table,
+                     ['company_id', 'eak_edi_bill_id'], where='eak_edi_bill_id IS NOT NULL')
+
+    @api.depends('edi_document_ids.state', 'edi_document_ids.blocking_level')
+    def _compute_eak_outbox_state(self):
+        for move in self:
+            document = move.edi_document_ids.filtered(lambda document: document.edi_format_id.code == 'EAKs')[:1]
+            if not document or document.state not in ('to_send', 'sent'):
+                move.eak_outbox_state = False
+            elif document.state == 'sent':
+                move.eak_outbox_state = 'sent'
+            elif document.blocking_level == 'error':
+                move.eak_outbox_state = 'failed'
+            else:
+                move.eak_outbox_state = document.blocking_level and 'retrying' or 'queued'
+
+    def write(self, vals):
+        # the PDF rendered for eAK shows more than the exported values: any change to the move
+        # but the eAK and EDI bookkeeping drops it
+        if any(not field.startswith(('eak_', 'edi_')) for field in vals):
+            self.eak_invoice_pdf_id.sudo().unlink()
+        return super().write(vals)
+
+    def _post(self, soft=True):
+        # EXTENDS account_edi: the eAK documents are sent by the outbox cron, not the posting user
+        posted = super()._post(soft=soft)
+        if posted.edi_document_ids.filtered(lambda document: document.edi_format_id.code == 'EAKs' and document.state == 'to_send'):
+            self.env['account.edi.document']._eak_trigger_outbox()
+        return posted
+
+    def _eak_payload(self):
+        """ The raw eAK XML of the move, only decompressed when asked for. """
+        self.ensure_one()
+        raw = self.eak_edi_payload_id.sudo().raw
+        return raw and gzip.decompress(raw).decode()
+
+    def _eak_store_payloads(self, payloads, summaries=None):
+        """ Keep the raw eAK XML of the moves of ``payloads`` {move: xml} as gzip attachments,
+            the moves only holding a reference to it and a summary, from ``summaries`` {move: text}
+            or the start of the XML.
+        """
+        summaries = summaries or {}
+        old = self.env['ir.attachment'].concat(*[move.eak_edi_payload_id for move in payloads])
+        to_store = [(move, payload) for move, payload in payloads.items() if payload]
+        attachments = self.env['ir.attachment'].sudo().create([{
+            'name': EAK_PAYLOAD_NAME,
+            'raw': gzip.compress(payload.encode()),
+            'res_model': self._name,
+            'res_id': move.id,
+            # kept out of the attachments of the chatter, like the binary fields
+            'res_field': 'eak_edi_payload_id',
+            'mimetype': 'application/gzip',
+        } for move, payload in to_store])
+        attachment_by_move = {move: attachment for (move, _payload), attachment in zip(to_store, attachments)}
+        for move, payload in payloads.items():
+            move.write({
+                'eak_edi_payload_id': attachment_by_move.get(move, False),
+                'eak_edi_summary': (summaries.get(move) or payload or '')[:EAK_SUMMARY_SIZE] or False,
+            })
+        old.sudo().unlink()
+
+    def action_view_eak_edi_response(self):
+        self.ensure_one()
+        response = self.env['account.move.eak.response'].create({'move_id': self.id, 'content': self._eak_payload()})
+        return {
+            'type': 'ir.actions.act_window',
+            'name': _('eAK Response'),
+            'res_model': response._name,
+            'res_id': response.id,
+            'views': [(False, 'form')],
+            'target': 'new',
+        }
 
     def button_draft(self):
         res = super().button_draft()
-        self.filtered("eak_edi_response").write({'eak_edi_response': ''})
+        moves = self.filtered("eak_edi_payload_id")
+        attachments = moves.eak_edi_payload_id
+        moves.write({'eak_edi_payload_id': False, 'eak_edi_summary': False})
+        attachments.sudo().unlink()
         return res
 
     # -------------------------------------------------------------------------
@@ -36,19 +141,31 @@ class AccountMove(models.Model):
         dt = dt or datetime.now()
         return dt.strftime(DEFAULT_eAK_DATE_FORMAT)
 
-    def _prepared_eak_invoice(self):
-        return {
+    def _prepared_eak_invoice(self, embed_pdf=True):
+        """ Values of the e-invoice of the move. With ``embed_pdf=False`` the invoice PDF is neither
+            rendered nor read, the AttachmentFile only names it (see _prepared_AttachmentFile_vals).
+        """
+        vals = {
             'authPhrase': self.company_id.eak_auth,
-            'Header': self._prepared_header_vals(),
             'InvoiceParties': self._prepared_InvoiceParties_vals(),
             'Invoice': self._prepared_Invoice_vals(),
             'InvoiceInformation': self._prepared_InvoiceInformation_vals(),
             **self._prepared_InvoiceSumGroup_vals(),
-            'AttachmentFile': self._prepared_AttachmentFile_vals(),
             'PaymentInfo': self._prepared_PaymentInfo_vals(),
             'Footer': self._prepared_Footer_vals(),
-            'invoice_lines': [vals._prepared_eak_invoice_line(self.format_monetary) for vals in \
-                self.invoice_line_ids.filtered(lambda x: x.display_type in ['product', False])]
+            'invoice_lines': self.invoice_line_ids.filtered(lambda x: x.display_type in ['product', False])\
+                ._prepared_eak_invoice_lines(self.format_monetary)
+        }
+        # version of the invoice content, the Header only holds the time of the export
+        digest = hashlib.sha1(json.dumps(vals, sort_keys=True, default=str).encode()).hexdigest()
+        return {
+            **vals,
+            'Header': self._prepared_header_vals(),
+            'AttachmentFile': self._prepared_AttachmentFile_vals(digest) if embed_pdf else {
+                'FileName': self._get_invoice_report_filename(),
+                'FileBase64': EAK_FILE_PLACEHOLDER,
+            },
+            'digest': digest,
         }
 
     def _prepared_header_vals(self):
@@ -94,19 +211,61 @@ class AccountMove(models.Model):
             'InvoiceSumGroup_InvoiceSum': self.format_monetary(self.amount_untaxed),
         }
 
-    def _prepared_AttachmentFile_vals(self):
-        pdf_content, pdf_name = self.get_invoice_pdf_report_attachment()
+    def _prepared_AttachmentFile_vals(self, digest):
+        pdf_name, open_pdf = self._eak_invoice_pdf(digest)
         return {
             'FileName': pdf_name,
-            'FileBase64': binascii.b2a_base64(pdf_content).decode('ascii')
+            'FileBase64': EAK_FILE_PLACEHOLDER,
+            'open': open_pdf,
         }
 
+    def _eak_invoice_pdf(self, digest):
+        """ Return the invoice PDF name and a callable opening it as a binary file, read straight
+            from the filestore when the PDF is stored there. The invoice PDF report is used when
+            there is one, otherwise the PDF is rendered once per version of its inputs (see
+            _eak_invoice_pdf_key) and kept on the move for the next exports, until the move changes.
+        """
+        attachment = self.invoice_pdf_report_id.sudo() or self._eak_cached_invoice_pdf(digest)
+        if attachment.store_fname:
+            path = attachment._full_path(attachment.store_fname)
+            return attachment.name, lambda: open(path, 'rb')
+        pdf_content = attachment.raw
+        return attachment.name, lambda: io.BytesIO(pdf_content)
+
+    def _eak_invoice_pdf_key(self, digest):
+        """ Version of the inputs of the invoice PDF: the ``digest`` of the exported values, and
+            the company (its layout, logo and footer) and partner printed on it. The other fields
+            of the move drop the PDF when written.
+        """
+        inputs = (digest, self.company_id.write_date, self.partner_id.write_date, self.partner_id.commercial_partner_id.write_date)
+        return hashlib.sha1(repr(inputs).encode()).hexdigest()
+
+    def _eak_cached_invoice_pdf(self, digest):
+        description = f"{EAK_PDF_CACHE_PREFIX}{self._eak_invoice_pdf_key(digest)}"
+        cached = self.eak_invoice_pdf_id.sudo()
+        if cached.description == description:
+            return cached
+        cached.unlink()
+        pdf_content, pdf_name = self.get_invoice_pdf_report_attachment()
+        attachment = self.env['ir.attachment'].sudo().create({
+            'name': pdf_name,
+            'raw': pdf_content,
+            'res_model': self._name,
+            'res_id': self.id,
+            # kept out of the attachments of the chatter, like the binary fields
+            'res_field': 'eak_invoice_pdf_id',
+            'mimetype': 'application/pdf',
+            'description': description,
+        })
+        self.eak_invoice_pdf_id = attachment
+        return attachment
+
     def _prepared_PaymentInfo_vals(self):
         return {
             'Currency': 'EUR',
             'PaymentDescription': self.name,
             'Payable': 'YES',
-            'PayDueDate': self.format_date(self.invoice_date_due),
+            'PayDueDate': self.invoice_date_due and self.format_date(self.invoice_date_due) or '',
             'PaymentTotalSum': self.format_monetary(self.amount_total),
             'PayerName': self.partner_id.name,
             'PaymentId': self.name,
@@ -116,8 +275,8 @@ class AccountMove(models.Model):
 
     def _prepared_Footer_vals(self):
         return {
-            'TotalNumberInvoices': '1',
-            'TotalAmount': self.format_monetary(self.amount_untaxed)
+            'TotalNumberInvoices': str(len(self)),
+            'TotalAmount': self.format_monetary(sum(self.mapped('amount_untaxed')))
         }
 
     #-------------------------------------------------------------------------
@@ -125,25 +284,56 @@ class AccountMove(models.Model):
     # -------------------------------------------------------------------------
 
     def _cron_sync_eak_vendor_attachments(self, batch_size=10):
-        cr = self.env.cr
-        companies = self.env['res.company']._get_companies()
-        domain = [('eak_edi_bill', '=', True), ('eak_edi_bill_attachment', '=', False)]
-        account_journal = self.env['account.journal']
-        logger = []
-        for company in companies:
-            eAk_obj = EstonianEInvoice(company.eak_url)
-            bills = self.with_company(company).search(domain, limit=batch_size)
-            eAk_response, error = bills._send_vendor_bill_attachment_request(eAk_obj)
+        companies = self.env['res.company']._get_companies()._eak_ready_companies('account_edi_eak.ir_cron_fetch_eak_vendor_attachments')
+        sync_run = self.env['account.edi.eak.sync.run']
+        stats = sync_run._new_stats(companies)
+        results = companies._eak_run_concurrently(
+            lambda company: self._eak_drain_vendor_attachments(company, batch_size=batch_size, stats=stats[company]),
+            commit=True, on_error=lambda company, eAk_response: (eAk_response, eAk_response['fault_string']))
+        sync_run._create_runs('attachments', results, stats)
+
+    def _eak_drain_vendor_attachments(self, company, batch_size=10, stats=None):
+        """ Walk fetching the attachments of every pending eAK bill of ``company``. Batches are sized
+            so that an answer weighs about account_edi_eak.attachment_batch_bytes, from the average
+            attachment size seen so far, and never hold less than ``batch_size`` bills. The drain stops
+            once account_edi_eak.attachment_run_bytes were received, the next run goes on from there.
+            EAK_COMMIT is yielded after each batch.
+        """
+        stats = stats or EakSyncStats()
+        ICP = self.env['ir.config_parameter'].sudo()
+        batch_bytes = int(ICP.get_param('account_edi_eak.attachment_batch_bytes', EAK_ATTACHMENT_BATCH_BYTES))
+        run_bytes = int(ICP.get_param('account_edi_eak.attachment_run_bytes', EAK_ATTACHMENT_RUN_BYTES))
+        eAk_obj = company._get_eak_client()
+        domain = [('eak_edi_bill', '=', True), ('eak_edi_bill_attachment', '=', False), ('company_id', '=', company.id)]
+        average, received, count = EAK_ATTACHMENT_AVERAGE_BYTES, 0, 0
+        tried = []
+        eAk_response, errors = {'level': 'success', 'row': ''}, []
+        while received < run_bytes:
+            limit = max(batch_size, min(EAK_ATTACHMENT_MAX_BATCH, batch_bytes // average))
+            with stats.phase('resolve'):
+                bills = self.with_company(company).search(domain + [('id', 'not in', tried)], limit=limit)
+            if not bills:
+                break
+            tried += bills.ids
+            eAk_response, error = yield from bills._send_vendor_bill_attachment_request(eAk_obj, stats)
             if error:
-                eAk_response.update({'message': error})
-                logger.append(account_journal._prepare_logger_values('eAk: Sync Vendor Bills Attachments', company.eak_url, eAk_response))
-            cr.commit()
-        self.env['ir.logging'].sudo().create(logger)
+                errors.append(error)
+                if eAk_response.get('fault_string'):
+                    break
+            received += eAk_response.get('bytes', 0)
+            count += eAk_response.get('attachments', 0)
+            average = max(received // (count or 1), 1024)
+            with stats.phase('commit'):
+                yield EAK_COMMIT
+        eAk_response['row'] = f"{count} attachments, {received} bytes received"
+        return eAk_response, "\n".join(errors)
 
     def action_get_eak_invoice_attachment(self):
         self.ensure_one()
-        eAk_obj = EstonianEInvoice(self.company_id.eak_url)
-        eAk_response, error=self._send_vendor_bill_attachment_request(eAk_obj)
+        eAk_obj = self.company_id._get_eak_client()
+        eAk_response, error = self.company_id._eak_run_concurrently(
+            lambda company: self._send_vendor_bill_attachment_request(eAk_obj),
+            on_error=lambda company, eAk_response: (eAk_response, eAk_response['fault_string']))[self.company_id]
         return {
             'type': 'ir.actions.client',
             'tag': error and 'display_notification' or 'reload',
@@ -155,62 +345,125 @@ class AccountMove(models.Model):
             }
         }
 
-    def _send_vendor_bill_attachment_request(self, eAk_obj):
+    def action_check_eak_partner_status(self):
+        """ Check now, whatever their last check, the eAK status of the customers of ``self``. """
+        companies = self.company_id.filtered(lambda company: company.eak_url and company.eak_auth)
+        return self.env['res.partner']._eak_check_status_now({
+            company: self.filtered(lambda move: move.company_id == company).partner_id.commercial_partner_id
+            for company in companies
+        })
+
+    def _send_vendor_bill_attachment_request(self, eAk_obj, stats=None):
+        """ Walk for res.company._eak_run_concurrently, following the startIndex pagination of the
+            answer until every bill of ``self`` got its attachment or eAK has nothing more.
+        """
+        stats = stats or EakSyncStats()
         if not self:
             message="Not have any Attachment for process"
             return {'level': "success", 'row': message}, True
         company = self[0].company_id
-        bill_names = self.mapped('eak_edi_bill_id')
+        bills = {bill.eak_edi_bill_id: bill for bill in self}
         vals = {
                 'authPhrase': company.eak_auth,
-                'invoiceIds': bill_names
+                'invoiceIds': list(bills),
+                'startIndex': 1,
             }
-        edi_content = self.env['ir.qweb']._render('account_edi_eak.invoice_attachment_request_eak_import',{'vals': vals})
-        eak_response = eAk_obj.getInvoiceAttachment(edi_content)
-        if eak_response.get('fault_string', ''):
-            error = company.name + "\n"+ eak_response.get('fault_string')
-            return eak_response, error
-        return self._process_vendor_bill_attachment(eak_response)
-
-    def _process_vendor_bill_attachment(self, eak_res):
-        edi_response = etree.XML(eak_res.get('row'))
-        ns = {
-            'erp': 'http://e-arvetekeskus.eu/erp',
-            **edi_response.nsmap
-        }
+        done = self.env['account.move']
+        received = attachments = 0
+        while True:
+            with stats.phase('build'):
+                edi_content = invoice_attachment_request(vals)
+            stats.payload('InvoiceAttachmentRequest', edi_content)
+            eak_response = yield partial(eAk_obj.getInvoiceAttachment, edi_content)
+            stats.add_response(eak_response)
+            if eak_response.get('fault_string', ''):
+                error = company.name + "\n"+ eak_response.get('fault_string')
+                return eak_response, error
+            page = eak_response.pop('records', [])
+            page_bytes = sum(len(record['content']) for record in page)
+            received += page_bytes
+            attachments += len(page)
+            with stats.phase('create'):
+                page_done = self._process_vendor_bill_attachment(page, bills)
+            done |= page_done
+            stats.count(received=len(page), created=len(page_done), bytes=page_bytes)
+            if not page or not self - done:
+                break
+            vals['startIndex'] += len(page)
+        eak_response.update({'bytes': received, 'attachments': attachments})
         error = False
-        invoice_tree_list= edi_response.findall(".//erp:InvoiceAttachmentResponse/InvoiceAttachment", ns)
-        has_bill_attachment_obj = self.env['account.move']
-        for invoice_tree in invoice_tree_list:
-            invoiceId = invoice_tree.attrib['invoiceId']
-            fileName = invoice_tree.attrib['fileName']
-            AttachmentContent = invoice_tree.findtext('AttachmentContent')
-            res_id = self.filtered(lambda bill:bill.eak_edi_bill_id == invoiceId)
-            if res_id:
-                has_bill_attachment_obj += res_id
-                self._create_attachment(fileName, AttachmentContent, res_id)
-        remaining_bills = self - has_bill_attachment_obj
+        remaining_bills = self - done
         if remaining_bills:
             error = f"List Of Invoice Not Found\n {remaining_bills.mapped('name')}"
-        return eak_res, error
-
-    def _create_attachment(self, subject_name, pdf_content, res_id):
-        attachment = self.env['ir.attachment'].create({
-            'name': subject_name,
-            'type': 'binary',
-            'datas': pdf_content.encode('ascii', 'ignore'),
-            'res_model': 'account.move',
-            'res_id': res_id.id,
-            'mimetype': 'application/pdf'
-        })
-        res_id.eak_edi_bill_attachment=True
-        return attachment
+        return eak_response, error
+
+    def _process_vendor_bill_attachment(self, records, bills):
+        """ Create the attachments of one answer page in bulk, the content being decoded already,
+            and flag their bills with a single write.
+
+            :param bills: {eak_edi_bill_id: bill}
+            :return: the bills that got an attachment
+        """
+        vals_list = []
+        has_bill_attachment_obj = self.env['account.move']
+        for record in records:
+            bill = bills.get(record['invoiceId'])
+            if bill:
+                has_bill_attachment_obj |= bill
+                vals_list.append({
+                    'name': record['fileName'],
+                    'type': 'binary',
+                    'raw': record['content'],
+                    'res_model': 'account.move',
+                    'res_id': bill.id,
+                    'mimetype': 'application/pdf'
+                })
+        self.env['ir.attachment'].create(vals_list)
+        has_bill_attachment_obj.write({'eak_edi_bill_attachment': True})
+        return has_bill_attachment_obj
 
 class AccountMoveLine(models.Model):
     _inherit = 'account.move.line'
     
     def _prepared_eak_invoice_line(self, format_monetary):
         vat_id = sum([tax.amount for tax in self.tax_ids])
+        vat_sum = vat_id and sum([abs(tax.get('balance', 0.0)) for tax in self.compute_all_tax.values()])
+        return self._eak_invoice_line_vals(format_monetary, vat_id, vat_sum)
+
+    def _prepared_eak_invoice_lines(self, format_monetary):
+        """ _prepared_eak_invoice_line of every line of ``self`` in one pass. The VAT of a product
+            line is its price_total minus its price_subtotal, already computed with the move, instead
+            of a compute_all_tax per line. Both are the same amount as long as every tax of the line
+            books its whole amount on a single repartition line; the other lines go the slow way.
+        """
+        self.fetch(['name', 'display_type', 'product_uom_id', 'quantity', 'price_unit', 'discount', 'price_subtotal',
+                    'price_total', 'balance', 'amount_currency', 'tax_ids'])
+        self.product_uom_id.fetch(['name'])
+        rates, simple = {}, {}
+        for taxes in {line.tax_ids for line in self}:
+            rates[taxes] = sum(taxes.mapped('amount'))
+            simple[taxes] = all(
+                tax.amount_type != 'group' and tax.amount >= 0 and all(
+                    len(repartition_lines) == 1 and repartition_lines.factor_percent == 100
+                    for repartition_lines in (
+                        tax.invoice_repartition_line_ids.filtered(lambda line: line.repartition_type == 'tax'),
+                        tax.refund_repartition_line_ids.filtered(lambda line: line.repartition_type == 'tax'),
+                    )
+                )
+                for tax in taxes
+            )
+        lines_vals = []
+        for line in self:
+            vat_id = rates[line.tax_ids]
+            if not vat_id or line.display_type != 'product' or not simple[line.tax_ids]:
+                lines_vals.append(line._prepared_eak_invoice_line(format_monetary))
+                continue
+            rate = line.amount_currency / line.balance if line.balance else 1
+            vat_sum = abs((line.price_total - line.price_subtotal) / rate)
+            lines_vals.append(line._eak_invoice_line_vals(format_monetary, vat_id, vat_sum))
+        return lines_vals
+
+    def _eak_invoice_line_vals(self, format_monetary, vat_id, vat_sum):
         line_vals = {
             'ItemEntry_Description': self.name,
             'ItemDetailInfo_ItemUnit': self.product_uom_id.name,
@@ -228,7 +481,6 @@ class AccountMoveLine(models.Model):
                 }
             )
         if vat_id:
-            vat_sum =  sum([abs(tax.get('balance', 0.0)) for tax in self.compute_all_tax.values()])
             line_vals.update(
                 {
                     'VAT_VATRate': int(vat_id),
@@ -1,6 +1,16 @@
 # -*- coding: utf-8 -*-
 # Part of Odoo. See LICENSE file for full copyright and licensing details.
-from odoo import models, fields
+import logging
+from datetime import timedelta
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from odoo import models, fields, modules
+from .account_edi_eak import EstonianEInvoice, ACTION_TIMEOUTS, MAX_RETRIES, POOL_SIZE, LOG_SAMPLE_RATE, RATE_LIMIT, \
+    _get_limiter, _get_session, get_transport
+
+_logger = logging.getLogger(__name__)
+EAK_COMPANY_WORKERS = 4
+# yielded by a walk to have res.company._eak_run_concurrently commit what it did so far
+EAK_COMMIT = object()
 
 
 class ResCompany(models.Model):
@@ -11,16 +21,125 @@ class ResCompany(models.Model):
     eak_bill_export_date = fields.Datetime('Last Sync Vendor Bill Date', copy=False, help="Vendor Bill Last Sync eAK date", readonly=True,
                         default=fields.Datetime.now().replace(year=2009, month=7, day=1, hour=0, minute=0, second=0, microsecond=0))
     eak_bank_id = fields.Many2one('res.partner.bank', string='eAK Bank', copy=False)
+    eak_bill_export_window = fields.Integer('Vendor Bill Export Window (minutes)', copy=False, readonly=True,
+                        help="Size of the next vendor bill export window, adapted to the eAK result cap")
+    eak_debug_payloads = fields.Boolean('Log Full eAK Payloads', copy=False,
+                        help="Log every request and response of this company in full, the auth phrase masked")
 
     def _get_eak_auth(self):
         if not all([self.eak_url, self.eak_auth]):
             return False, {'level': "error", 'error_type': 'danger', 'fault_string': 'Please add eAk auth token/eAk URL'}
         return self.eak_auth, False
 
+    def _get_eak_client(self):
+        self.ensure_one()
+        ICP = self.env['ir.config_parameter'].sudo()
+        timeouts = {
+            action: float(ICP.get_param(f'account_edi_eak.timeout_{action}', timeout))
+            for action, timeout in ACTION_TIMEOUTS.items()
+        }
+        pool_size = int(ICP.get_param('account_edi_eak.pool_size', POOL_SIZE))
+        # 'record' keeps every exchange as a cassette of account_edi_eak.cassette_dir, 'replay' answers
+        # from them after account_edi_eak.replay_latency seconds ('recorded': the recorded time)
+        latency = ICP.get_param('account_edi_eak.replay_latency', '0')
+        transport = get_transport(
+            ICP.get_param('account_edi_eak.transport', 'live'),
+            _get_session(self.eak_url, pool_size),
+            directory=ICP.get_param('account_edi_eak.cassette_dir'),
+            latency=None if latency == 'recorded' else float(latency),
+        )
+        return EstonianEInvoice(
+            self.eak_url,
+            pool_size=pool_size,
+            timeouts=timeouts,
+            retries=int(ICP.get_param('account_edi_eak.max_retries', MAX_RETRIES)),
+            log_sample_rate=float(ICP.get_param('account_edi_eak.log_sample_rate', LOG_SAMPLE_RATE)),
+            debug=self.eak_debug_payloads,
+            limiter=_get_limiter((self.env.cr.dbname, self.id), float(ICP.get_param('account_edi_eak.rate_limit', RATE_LIMIT))),
+            transport=transport,
+        )
+
+    def _eak_ready_companies(self, cron_xmlid):
+        """ The companies of ``self`` whose eAK endpoint takes calls now. The cron ``cron_xmlid`` is
+            triggered again for when the first of the others will, instead of spending its run on
+            calls bound to fail.
+        """
+        waits = {company: company._get_eak_client().retry_after() for company in self}
+        deferred = [wait for wait in waits.values() if wait]
+        if deferred:
+            self.env.ref(cron_xmlid).sudo()._trigger(at=fields.Datetime.now() + timedelta(seconds=min(deferred) + 1))
+        return self.filtered(lambda company: not waits[company])
+
     def _get_companies(self):
         company_domain = [('eak_url', '!=', ''), ('eak_auth', '!=', '')]
         companies = self.search(company_domain)
         return companies
 
+    def _eak_run_concurrently(self, walk, commit=False, on_error=None):
+        """ Run one ``walk(company)`` generator per company of ``self``.
+
+            A walk yields callables holding only network work (the HTTP call and the parsing of its
+            answer, no ORM access); they run in a thread pool bounded by
+            account_edi_eak.company_workers and their result is sent back into the walk. The walks
+            themselves, and so every ORM read and write, run in the calling thread on its cursor,
+            one step at a time. A slow eAK answer for one company no longer holds up the others and
+            the total duration follows the slowest company, not the sum of all of them.
+
+            Each step of a walk runs under its own savepoint: a step raising is rolled back, the
+            walk of that company stops with an error response as result (mapped by
+            ``on_error(company, eAk_response)`` when given) and the other walks go on. The walks
+            never commit themselves, they yield EAK_COMMIT instead; with ``commit`` the transaction
+            is committed there and once each company is done, only ever between two steps, so that
+            the work of another company in it is complete.
+
+            :return: {company: value returned by its walk}
+        """
+        max_workers = int(self.env['ir.config_parameter'].sudo().get_param('account_edi_eak.company_workers', EAK_COMPANY_WORKERS))
+        results = {}
+        pending = {}
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+
+            def _fail(company, error):
+                _logger.exception("eAK: the walk of company %s failed", company.name)
+                eAk_response = {'level': 'error', 'error_type': 'danger', 'fault_string': str(error), 'row': ''}
+                results[company] = on_error(company, eAk_response) if on_error else eAk_response
+
+            def _advance(company, company_walk, value=None, exception=None):
+                while True:
+                    try:
+                        with self.env.cr.savepoint():
+                            try:
+                                job = company_walk.throw(exception) if exception else company_walk.send(value)
+                            except StopIteration as stop:
+                                results[company] = stop.value
+                                job = company_walk = None
+                    except Exception as error:
+                        _fail(company, error)
+                        return
+                    if company_walk and job is not EAK_COMMIT:
+                        pending[executor.submit(job)] = (company, company_walk)
+                        return
+                    # the module tests roll their transaction back, never commit it
+                    if commit and not modules.module.current_test:
+                        self.env.cr.commit()
+                    if not company_walk:
+                        return
+                    value = exception = None
+
+            for company in self:
+                try:
+                    company_walk = walk(company)
+                except Exception as error:
+                    _fail(company, error)
+                    continue
+                _advance(company, company_walk)
+            while pending:
+                done, _not_done = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    company, company_walk = pending.pop(future)
+                    exception = future.exception()
+                    _advance(company, company_walk, None if exception else future.result(), exception)
+        return results
+
     def update_date(self):
         self.eak_bill_export_date = fields.Datetime.now()
\ No newline at end of file
@@ -1,52 +1,156 @@
 # -*- coding: utf-8 -*-
 # Part of Odoo. See LICENSE file for full copyright and licensing details.
+from datetime import timedelta
+from functools import partial
+from concurrent.futures import ThreadPoolExecutor
 from lxml import etree
-from odoo import models, fields, _
-from .account_edi_eak import EstonianEInvoice
+from odoo import api, models, fields, _
+from odoo.tools.sql import create_index
+from .account_edi_eak_envelope import company_status_request
+from .account_edi_eak_sync_run import EakSyncStats
+
+EAK_STATUS_BATCH_SIZE = 90
+EAK_STATUS_WORKERS = 4
+# days an eAK status is trusted before the cron checks it again
+EAK_STATUS_TTL_DAYS = 30
 
 
 class ResPartner(models.Model):
     _inherit = "res.partner"
 
     is_edi_eak = fields.Boolean('Send to eAK', readonly=True)
+    eak_status_checked_at = fields.Datetime('eAK Status Checked', readonly=True, copy=False)
+
+    def init(self):
+        super().init()
+        create_index(self._cr, 'res_partner_eak_status_checked_at_index', self._table, ['eak_status_checked_at'],
+                     where="is_company AND company_registry IS NOT NULL AND company_registry != ''")
+
+    @api.model_create_multi
+    def create(self, vals_list):
+        partners = super().create(vals_list)
+        if any(vals.get('company_registry') for vals in vals_list):
+            self._eak_trigger_status_check()
+        return partners
+
+    def write(self, vals):
+        # the status eAK gave is the one of the former registry, it is unknown until checked again
+        changed = self.filtered(lambda partner: partner.company_registry != vals['company_registry']) if 'company_registry' in vals else self.browse()
+        res = super().write(vals)
+        if changed:
+            changed.write({'is_edi_eak': False, 'eak_status_checked_at': False})
+            if vals['company_registry']:
+                self._eak_trigger_status_check()
+        return res
+
+    def _eak_trigger_status_check(self):
+        """ Run the status cron soon, it picks up the partners never checked. """
+        cron = self.env.ref('account_edi_eak.ir_cron_fetch_eak_values', raise_if_not_found=False)
+        if cron:
+            cron.sudo()._trigger()
+
+    def _eak_status_due_domain(self):
+        ttl = int(self.env['ir.config_parameter'].sudo().get_param('account_edi_eak.status_ttl_days', EAK_STATUS_TTL_DAYS))
+        return [
+            ('company_registry', 'not in', [False, '']),
+            ('is_company', '=', True),
+            '|', ('eak_status_checked_at', '=', False),
+                 ('eak_status_checked_at', '<', fields.Datetime.now() - timedelta(days=ttl)),
+        ]
+
+    def action_check_eak_status(self):
+        """ Check now, whatever their last check, the eAK status of ``self`` for the current
+            companies set up for eAK.
+        """
+        companies = self.env.companies.filtered(lambda company: company.eak_url and company.eak_auth)
+        return self._eak_check_status_now({company: self.commercial_partner_id for company in companies})
+
+    def _eak_check_status_now(self, partners_by_company):
+        """ Check the status of the partners of ``partners_by_company`` {company: partners} with the
+            eAK account of their company and return the notification of the result.
+        """
+        companies = self.env['res.company'].concat(*partners_by_company)
+        results = companies._eak_run_concurrently(
+            lambda company: self._process_to_update_edi_eak_value(company, partners=partners_by_company[company]),
+            on_error=lambda company, eAk_response: (eAk_response, eAk_response['fault_string']))
+        if not companies:
+            error = _("No company is set up for eAK.")
+        else:
+            error = "\n".join(error for _eAk_response, error in results.values() if error)
+        return {
+            'type': 'ir.actions.client',
+            'tag': 'display_notification',
+            'params': {
+                'title': _('eAK Partner Status'),
+                'type': error and 'danger' or 'info',
+                'message': error or "\n".join(eAk_response.get('row', '') for eAk_response, _error in results.values()),
+                'sticky': False,
+            }
+        }
 
     def _cron_sync_eak_partners(self):
-        logger = []
-        account_journal = self.env['account.journal']
-        companies = self.env['res.company']._get_companies()
-        for company in companies:
-            eAk_response, error = self._process_to_update_edi_eak_value(company)
-            if not error:
-                eAk_response.update({'level': 'success'})
-            logger.append(account_journal._prepare_logger_values('eAk: Sync Clients Status', company.eak_url, eAk_response))
-        self.env['ir.logging'].sudo().create(logger)
-
-    def _process_to_update_edi_eak_value(self, company):
-        edi_contents, error = self._get_partner_edi_content(company)
+        companies = self.env['res.company']._get_companies()._eak_ready_companies('account_edi_eak.ir_cron_fetch_eak_values')
+        sync_run = self.env['account.edi.eak.sync.run']
+        stats = sync_run._new_stats(companies)
+        results = companies._eak_run_concurrently(
+            lambda company: self._process_to_update_edi_eak_value(company, stats[company]), commit=True,
+            on_error=lambda company, eAk_response: (eAk_response, eAk_response['fault_string']))
+        sync_run._create_runs('partners', results, stats)
+
+    def _process_to_update_edi_eak_value(self, company, stats=None, partners=None):
+        """ Walk for res.company._eak_run_concurrently checking the status of ``partners``, by
+            default of the partners whose last check is older than account_edi_eak.status_ttl_days.
+            The status batches are yielded as one network job, the merged answer of the batches eAK
+            answered is applied here and the faults of the others are reported, their partners being
+            checked again by the next run.
+        """
+        stats = stats or EakSyncStats()
+        with stats.phase('build'):
+            if partners is None:
+                partners = self.search(self._eak_status_due_domain())
+            regNumber_batches, edi_contents, error = self._get_partner_edi_content(company, partners)
         if error:
             return {}, error
-        
-        eAk_obj = EstonianEInvoice(company.eak_url)
-        full_response = {}
-
         for edi_content in edi_contents:
-            eAk_response = eAk_obj.getClientStatus(edi_content)
+            stats.payload('CompanyStatusRequest', edi_content)
+
+        eAk_obj = company._get_eak_client()
+        max_workers = int(self.env['ir.config_parameter'].sudo().get_param('account_edi_eak.status_workers', EAK_STATUS_WORKERS))
+        eAk_responses = yield partial(self._send_status_batches, eAk_obj, edi_contents, max_workers)
+
+        statuses = {}
+        checked = set()
+        faults = []
+        for batch, eAk_response in zip(regNumber_batches, eAk_responses):
+            stats.add_response(eAk_response)
             if eAk_response.get('fault_string'):
-                error = company.name + "\n"+ eAk_response.get('fault_string')
-                return eAk_response, error
-            
-        self._process_to_update_partners(eAk_response.get('row'))
-        full_response.update(eAk_response)
-        return full_response, error
-
-    def _get_partner_edi_content(self, company):
-        domain = [('company_registry', '!=', ''), ('is_company','=', True)]
+                faults.append(eAk_response.get('fault_string'))
+                continue
+            stats.payload('CompanyStatusResponse', eAk_response.get('row'))
+            with stats.phase('parse'):
+                statuses.update(self._parse_partner_statuses(eAk_response.get('row')))
+            checked.update(batch)
+
+        with stats.phase('create'):
+            unknown_partners, updated = self._process_to_update_partners(statuses)
+            partners.filtered(lambda partner: partner.company_registry in checked).write({'eak_status_checked_at': fields.Datetime.now()})
+        stats.count(received=len(statuses), updated=updated, unchanged=len(statuses) - updated)
+        row = f"{len(statuses)} partner status received from {len(edi_contents) - len(faults)} of {len(edi_contents)} batches\n{unknown_partners}"
+        if faults:
+            error = company.name + "\n" + "\n".join(faults)
+        return {'level': 'success', 'row': row}, error
+
+    @staticmethod
+    def _send_status_batches(eAk_obj, edi_contents, max_workers):
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            return list(executor.map(eAk_obj.getClientStatus, edi_contents))
+
+    def _get_partner_edi_content(self, company, partners):
         error = ""
-        partners = self.search(domain)
-        regNumbers = partners.mapped('company_registry')
+        partners = partners.filtered(lambda partner: partner.is_company and partner.company_registry)
+        regNumbers = list(dict.fromkeys(partners.mapped('company_registry')))
 
-        # Split regNumbers into batches of 100
-        batch_size = 90
+        batch_size = EAK_STATUS_BATCH_SIZE
         regNumber_batches = [regNumbers[i:i + batch_size] for i in range(0, len(regNumbers), batch_size)]
 
         edi_contents=[]
@@ -55,23 +159,34 @@ class ResPartner(models.Model):
                     'authPhrase': company.eak_auth,
                     'regNumbers': batch
                 }
-            edi_content = self.env['ir.qweb']._render('account_edi_eak.company_status_code_import',{'vals': vals})
+            edi_content = company_status_request(vals)
             edi_contents.append(edi_content)
-        return edi_contents, error
+        return regNumber_batches, edi_contents, error
 
-    def _process_to_update_partners(self, row):
+    def _parse_partner_statuses(self, row):
         edi_response = etree.XML(row)
         ns = {
             'erp': 'http://e-arvetekeskus.eu/erp',
             **edi_response.nsmap
         }
-        unknown_partners = ''
         partner_tree_list= edi_response.findall(".//SOAP-ENV:Body/erp:CompanyStatusResponse/erp:CompanyActive", ns)
-        for partner_tree in partner_tree_list:
-            regNumber = partner_tree.attrib['regNumber']
-            partner = self.search([('company_registry', '=', regNumber), ('company_registry', '!=', '')], limit=1)
-            if partner:
-                partner.is_edi_eak = True if partner_tree.text == 'YES' else False
-            else:
-                unknown_partners += (_(f"Partner regNumber: {regNumber} Not Find"))
-        return unknown_partners
+        return {partner_tree.attrib['regNumber']: partner_tree.text for partner_tree in partner_tree_list}
+
+    def _process_to_update_partners(self, statuses):
+        """ Apply the eAK answers {regNumber: 'YES'/'NO'} with one write per value, only on the
+            partners whose flag actually changes.
+
+            :return: the registries without partner, as text, and the count of partners updated
+        """
+        to_enable, to_disable = [], []
+        known = set()
+        domain = [('company_registry', 'in', list(statuses)), ('company_registry', '!=', '')]
+        for partner in self.search_fetch(domain, ['company_registry', 'is_edi_eak']):
+            known.add(partner.company_registry)
+            is_edi_eak = statuses[partner.company_registry] == 'YES'
+            if partner.is_edi_eak != is_edi_eak:
+                (to_enable if is_edi_eak else to_disable).append(partner.id)
+        self.browse(to_enable).write({'is_edi_eak': True})
+        self.browse(to_disable).write({'is_edi_eak': False})
+        unknown = "".join(_(f"Partner regNumber: {regNumber} Not Find") for regNumber in statuses if regNumber not in known)
+        return unknown, len(to_enable) + len(to_disable)
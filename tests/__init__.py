@@ -1 +1,7 @@
-from . import test_sync_eak_partners
\ No newline at end of file
+from . import test_sync_eak_partners
+from . import test_eak_transport
+from . import test_import_eak_vendor_bills
+from . import test_eak_envelopes
+from . import test_eak_benchmark
+from . import test_eak_outbox
+from . import test_eak_journal_dashboard
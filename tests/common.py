@@ -0,0 +1,216 @@
+# -*- coding: utf-8 -*-
+# Part of Odoo. See LICENSE file for full copyright and licensing details.
+import time
+import base64
+import random
+import threading
+from datetime import datetime, timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from lxml import etree
+
+ERP = 'http://e-arvetekeskus.eu/erp'
+
+STATUS_RESPONSE = b'''<SOAP-ENV:Envelope xmlns:SOAP-ENV="http://schemas.xmlsoap.org/soap/envelope/">
+    <SOAP-ENV:Body>
+        <erp:CompanyStatusResponse xmlns:erp="http://e-arvetekeskus.eu/erp">
+            <ErrorCode>0</ErrorCode>
+            <erp:CompanyActive regNumber="123456">YES</erp:CompanyActive>
+        </erp:CompanyStatusResponse>
+    </SOAP-ENV:Body>
+</SOAP-ENV:Envelope>'''
+ERROR_RESPONSE = b'''<SOAP-ENV:Envelope xmlns:SOAP-ENV="http://schemas.xmlsoap.org/soap/envelope/">
+    <SOAP-ENV:Body>
+        <SOAP-ENV:Fault><faultcode>SOAP-ENV:Server</faultcode><faultstring>Service unavailable</faultstring></SOAP-ENV:Fault>
+    </SOAP-ENV:Body>
+</SOAP-ENV:Envelope>'''
+
+
+class _EakStubHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+
+    def setup(self):
+        super().setup()
+        with self.server.lock:
+            self.server.connections += 1
+
+    def _read_body(self):
+        if self.headers.get('Transfer-Encoding', '').lower() == 'chunked':
+            body = b''
+            while True:
+                size = int(self.rfile.readline().split(b';')[0], 16)
+                if not size:
+                    self.rfile.readline()
+                    return body
+                body += self.rfile.read(size)
+                self.rfile.readline()
+        return self.rfile.read(int(self.headers.get('Content-Length', 0)))
+
+    def do_POST(self):
+        server = self.server
+        body = self._read_body()
+        action = self.headers.get('SOAPAction', '')
+        with server.lock:
+            server.requests.append((action, len(body)))
+            failed = server.random.random() < server.error_rate
+        if server.latency:
+            time.sleep(server.latency)
+        if failed:
+            status, payload = server.error_status, ERROR_RESPONSE
+        elif server.responder:
+            status, payload = 200, server.responder(action.strip('"'), body)
+        else:
+            status, payload = server.status, server.response_body
+        self.send_response(status)
+        self.send_header('Content-Type', 'text/xml; charset=utf-8')
+        self.send_header('Content-Length', str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class EakStubServer:
+    """ Local stand-in for the eAK SOAP endpoint, answering every POST with ``response_body``, or
+        with ``responder(action, body)`` when given (see SyntheticEak). Each answer is delayed by
+        ``latency`` seconds, and a share ``error_rate`` of them is replaced by an ``error_status``
+        SOAP fault.
+    """
+
+    def __init__(self, response_body=STATUS_RESPONSE, status=200, responder=None, latency=0, error_rate=0,
+                 error_status=503, seed=0):
+        self.httpd = ThreadingHTTPServer(('127.0.0.1', 0), _EakStubHandler)
+        self.httpd.daemon_threads = True
+        self.httpd.lock = threading.Lock()
+        self.httpd.connections = 0
+        self.httpd.requests = []
+        self.httpd.response_body = response_body
+        self.httpd.status = status
+        self.httpd.responder = responder
+        self.httpd.latency = latency
+        self.httpd.error_rate = error_rate
+        self.httpd.error_status = error_status
+        self.httpd.random = random.Random(seed)
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+
+    @property
+    def url(self):
+        return 'http://127.0.0.1:%s/' % self.httpd.server_address[1]
+
+    @property
+    def connections(self):
+        return self.httpd.connections
+
+    @property
+    def requests(self):
+        return self.httpd.requests
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
+def vendor_bill_xml(invoice_id, company_registry, seller_registry, line_count=1, default_code='',
+                    vat_rate=22, currency='EUR', pay_to_account=''):
+    """ <Invoice> element as found in a BuyInvoiceExportRequest answer. """
+    lines = ''.join(f'''
+            <InvoiceItemGroup>
+                <ItemEntry>
+                    <Description>Line {index}</Description>
+                    <ItemReserve><InformationContent>{default_code}</InformationContent></ItemReserve>
+                    <ItemDetailInfo><ItemAmount>1</ItemAmount><ItemPrice>100.00</ItemPrice></ItemDetailInfo>
+                    <ItemSum>100.00</ItemSum>
+                    <VAT vatId="TAX"><VATRate>{vat_rate}</VATRate><VATSum>{vat_rate:.2f}</VATSum></VAT>
+                    <ItemTotal>{100 + vat_rate:.2f}</ItemTotal>
+                </ItemEntry>
+            </InvoiceItemGroup>''' for index in range(line_count))
+    return f'''<Invoice invoiceId="{invoice_id}" regNumber="{company_registry}" sellerRegnumber="{seller_registry}">
+        <InvoiceParties>
+            <SellerParty><Name>Seller {seller_registry}</Name><RegNumber>{seller_registry}</RegNumber></SellerParty>
+            <BuyerParty><Name>Buyer {company_registry}</Name><RegNumber>{company_registry}</RegNumber></BuyerParty>
+        </InvoiceParties>
+        <InvoiceInformation>
+            <InvoiceNumber>BILL/{invoice_id}</InvoiceNumber>
+            <InvoiceDate>2024-01-15</InvoiceDate>
+            <DueDate>2024-02-15</DueDate>
+        </InvoiceInformation>
+        <InvoiceSumGroup><Currency>{currency}</Currency></InvoiceSumGroup>
+        <InvoiceItem>{lines}
+        </InvoiceItem>
+        <PaymentInfo>
+            <PayToAccount>{pay_to_account}</PayToAccount>
+            <PaymentDescription>BILL/{invoice_id}</PaymentDescription>
+        </PaymentInfo>
+    </Invoice>'''
+
+
+def _soap_response(response_tag, content):
+    return (f'''<SOAP-ENV:Envelope xmlns:SOAP-ENV="http://schemas.xmlsoap.org/soap/envelope/"><SOAP-ENV:Body>'''
+            f'''<erp:{response_tag} xmlns:erp="{ERP}"><ErrorCode>0</ErrorCode>''').encode() + content \
+        + f'''</erp:{response_tag}></SOAP-ENV:Body></SOAP-ENV:Envelope>'''.encode()
+
+
+class SyntheticEak:
+    """ Synthetic eAK account of the company ``company_registry``: ``bills`` vendor bills of
+        ``lines`` lines from ``partners`` sellers, dated evenly over the last ``days`` days, each
+        with a PDF of ``pdf_size`` bytes. ``respond`` answers the eAK actions from this data, to be
+        used as the responder of an EakStubServer; exports return at most ``cap`` bills and
+        attachment answers at most ``attachment_page`` attachments. Bill ids start with
+        ``bill_prefix`` and seller registries count from ``first_registry``.
+    """
+
+    def __init__(self, company_registry, bills=0, lines=1, partners=1, pdf_size=1024, days=10, cap=100,
+                 attachment_page=50, default_code='', vat_rate=22, bill_prefix='SYN', first_registry=30000000):
+        self.company_registry = company_registry
+        self.partner_registries = [str(first_registry + index) for index in range(partners)]
+        self.until = datetime.now()
+        self.since = self.until - timedelta(days=days)
+        step = (self.until - self.since) / max(bills, 1)
+        self.bills = [
+            (f'{bill_prefix}{index:06d}', self.since + step * index, self.partner_registries[index % partners])
+            for index in range(bills)
+        ]
+        self.lines = lines
+        self.cap = cap
+        self.attachment_page = attachment_page
+        self.default_code = default_code
+        self.vat_rate = vat_rate
+        pdf = b'%PDF-1.4\n' + b'0' * max(pdf_size - 9, 0)
+        self.pdf_base64 = base64.b64encode(pdf)
+
+    def partner_vals(self):
+        return [
+            {'name': f'Seller {registry}', 'company_registry': registry, 'is_company': True}
+            for registry in self.partner_registries
+        ]
+
+    def respond(self, action, body):
+        request = etree.fromstring(body).find(f'.//{{{ERP}}}{action}') if action != 'EInvoice' else None
+        if action == 'BuyInvoiceExportRequest':
+            since = datetime.fromisoformat(request.get('since'))
+            till = datetime.fromisoformat(request.get('till')) if request.get('till') else self.until
+            selected = [bill for bill in self.bills if since <= bill[1] < till][:self.cap]
+            return _soap_response('BuyInvoiceExportResponse', ''.join(
+                vendor_bill_xml(invoice_id, self.company_registry, seller, line_count=self.lines,
+                                default_code=self.default_code, vat_rate=self.vat_rate)
+                for invoice_id, _date, seller in selected
+            ).encode())
+        if action == 'CompanyStatusRequest':
+            return _soap_response('CompanyStatusResponse', ''.join(
+                f'<erp:CompanyActive regNumber="{registry}">YES</erp:CompanyActive>'
+                for registry in request.itertext(f'{{{ERP}}}RegNumber')
+            ).encode())
+        if action == 'InvoiceAttachmentRequest':
+            invoice_ids = [element.text for element in request.iterfind(f'{{{ERP}}}invoiceId')]
+            start = int(request.get('startIndex', 1)) - 1
+            return _soap_response('InvoiceAttachmentResponse', b''.join(
+                f'<InvoiceAttachment invoiceId="{invoice_id}" fileName="{invoice_id}.pdf"><AttachmentContent>'.encode()
+                + self.pdf_base64 + b'</AttachmentContent></InvoiceAttachment>'
+                for invoice_id in invoice_ids[start:start + self.attachment_page]
+            ))
+        return _soap_response('EInvoiceResponse', b'')
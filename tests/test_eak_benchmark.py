@@ -0,0 +1,108 @@
+import time
+import logging
+import tracemalloc
+from unittest.mock import patch
+from odoo.tests import tagged
+from odoo.addons.account.tests.common import AccountTestInvoicingCommon
+from .common import EakStubServer, SyntheticEak
+
+_logger = logging.getLogger(__name__)
+
+# (vendor bills, lines per bill, partners, PDF bytes)
+SCALES = [
+    (20, 5, 10, 50 * 1024),
+    (200, 20, 100, 200 * 1024),
+]
+
+
+@tagged('post_install', '-at_install', 'eak_benchmark', '-standard')
+class TestEakBenchmark(AccountTestInvoicingCommon):
+    """ Times the eAK crons and the outgoing export against a SyntheticEak stand-in, reporting wall
+        time, query count and peak Python memory per step and scale.
+
+        Run with --test-tags eak_benchmark.
+    """
+
+    @classmethod
+    def setUpClass(cls, chart_template_ref=None):
+        super().setUpClass(chart_template_ref=chart_template_ref)
+        cls.env.ref('base.EUR').active = True
+        cls.company = cls.company_data['company']
+        cls.company.write({
+            'company_registry': '10000001',
+            'eak_auth': 'test_auth',
+            'street': 'Narva mnt 5',
+            'city': 'Tallinn',
+        })
+        cls.company.eak_bank_id = cls.env['res.partner.bank'].create({
+            'acc_number': 'EE382200221020145685',
+            'partner_id': cls.company.partner_id.id,
+        })
+        cls.product_a.default_code = 'EAK-A'
+        cls.tax_purchase = cls.company_data['default_tax_purchase']
+
+    def _measure(self, label, function):
+        self.env.invalidate_all()
+        sql_log_count = self.env.cr.sql_log_count
+        tracemalloc.start()
+        start = time.perf_counter()
+        function()
+        wall = time.perf_counter() - start
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        _logger.info("eAK benchmark %-45s %8.2f s %7d queries %8.1f MiB peak",
+                     label, wall, self.env.cr.sql_log_count - sql_log_count, peak / 2 ** 20)
+
+    def _run(self, walk):
+        # the walks of the crons, without their commits
+        return self.company._eak_run_concurrently(walk)
+
+    def _export_invoices(self, partners, count, lines):
+        return self.env['account.move'].create([{
+            'move_type': 'out_invoice',
+            'partner_id': partners[index % len(partners)].id,
+            'invoice_date': '2024-01-15',
+            'invoice_line_ids': [(0, 0, {'product_id': self.product_a.id, 'price_unit': 100.0})] * lines,
+        } for index in range(count)])
+
+    def test_benchmark(self):
+        for index, (bills, lines, partner_count, pdf_size) in enumerate(SCALES):
+            scale = f"{bills} bills x {lines} lines, {partner_count} partners, {pdf_size // 1024} KiB PDF"
+            with self.subTest(scale=scale):
+                bill_prefix = f'SYN{index}-'
+                synthetic = SyntheticEak('10000001', bills=bills, lines=lines, partners=partner_count, pdf_size=pdf_size,
+                                         default_code='EAK-A', vat_rate=self.tax_purchase.amount,
+                                         bill_prefix=bill_prefix, first_registry=30000000 + 10000 * index)
+                partners = self.env['res.partner'].create([
+                    dict(vals, street='Narva mnt 7', city='Tallinn') for vals in synthetic.partner_vals()
+                ])
+                self.company.write({'eak_bill_export_date': synthetic.since, 'eak_bill_export_window': False})
+                pdf = (b'%PDF-1.4\n' + b'0' * (pdf_size - 9), 'invoice.pdf')
+                with EakStubServer(responder=synthetic.respond) as server, \
+                        patch.object(self.env.registry['account.move'], 'get_invoice_pdf_report_attachment', return_value=pdf):
+                    self.company.eak_url = server.url
+                    self._measure(f"fetch vendor bills, {scale}", lambda: self._run(
+                        lambda company: self.env['account.journal']._eak_fetch_vendor_bill_windows(company._get_eak_client(), company)))
+                    imported = self.env['account.move'].search([('eak_edi_bill_id', '=like', f'{bill_prefix}%')])
+                    self.assertEqual(len(imported), bills)
+
+                    self._measure(f"sync partner statuses, {scale}", lambda: self._run(
+                        lambda company: self.env['res.partner']._process_to_update_edi_eak_value(company)))
+                    self.assertTrue(all(partners.mapped('is_edi_eak')))
+
+                    self._measure(f"fetch vendor bill attachments, {scale}", lambda: self._run(
+                        lambda company: self.env['account.move']._eak_drain_vendor_attachments(company)))
+                    self.assertTrue(all(imported.mapped('eak_edi_bill_attachment')))
+
+                    invoices = self._export_invoices(partners, bills, lines)
+                    edi_format = self.env.ref('account_edi_eak.edi_in_invoice_eak')
+                    results = {}
+                    self._measure(f"export invoices, {scale}", lambda: results.update(edi_format._account_edi_eak(invoices)))
+                    self.assertTrue(all(result.get('success') for result in results.values()))
+
+    def test_line_serialization_benchmark(self):
+        invoice = self._export_invoices(self.partner_a, 1, 5000)
+        lines = invoice.invoice_line_ids
+        self._measure("5000 lines, per line serialization",
+                      lambda: [line._prepared_eak_invoice_line(invoice.format_monetary) for line in lines])
+        self._measure("5000 lines, batch serialization", lambda: lines._prepared_eak_invoice_lines(invoice.format_monetary))
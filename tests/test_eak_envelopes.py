@@ -0,0 +1,323 @@
+import io
+import os
+import time
+import tempfile
+import logging
+from datetime import datetime
+from types import SimpleNamespace
+from unittest.mock import patch
+from lxml import etree
+from odoo.tests import tagged
+from odoo.tests.common import TransactionCase
+from odoo.tools.misc import file_open
+from odoo.tools.xml_utils import cleanup_xml_node
+from odoo.addons.account.tests.common import AccountTestInvoicingCommon
+from odoo.addons.account_edi_eak.models import account_edi_eak_envelope as envelopes
+from odoo.addons.account_edi_eak.models.account_edi_eak import EstonianEInvoice
+
+_logger = logging.getLogger(__name__)
+
+
+LINE_VALS = {
+    'ItemEntry_Description': 'Desk & chair <set>',
+    'ItemDetailInfo_ItemUnit': 'Units',
+    'ItemDetailInfo_ItemAmount': 2.0,
+    'ItemDetailInfo_ItemPrice': '50.00',
+    'ItemSum': '100.00',
+    'Addition_AddContent': 'Discount',
+    'Addition_AddRate': '-10.00',
+    'Addition_AddSum': '-10.00',
+    'VAT_VATRate': 22.0,
+    'VAT_VATSum': '19.80',
+}
+# (template, builder, vals, golden file)
+CASES = [
+    ('account_edi_eak.company_status_code_import', envelopes.company_status_request,
+     {'authPhrase': 'test_auth', 'regNumbers': ['10000001', '20000002', 'R&D <3>']}, 'company_status_request.xml'),
+    ('account_edi_eak.invoice_attachment_request_eak_import', envelopes.invoice_attachment_request,
+     {'authPhrase': 'test_auth', 'invoiceIds': [101, 102], 'startIndex': 3}, 'invoice_attachment_request.xml'),
+    ('account_edi_eak.account_invoice_edi_eak_import', envelopes.buy_invoice_export_request,
+     {'authPhrase': 'test_auth', 'from_date': datetime(2024, 1, 15), 'to_date': datetime(2024, 1, 16, 12, 30)},
+     'buy_invoice_export_request.xml'),
+]
+EXPORT_VALS = {
+    'authPhrase': 'test_auth',
+    'Header': {'Date': '2024-01-15', 'FileId': 'INV/2024/00001', 'Version': '1.2'},
+    'Invoice': {'sellerRegnumber': '10000001', 'invoiceId': 'INV/2024/00001', 'regNumber': '20000002'},
+    'InvoiceParties': {
+        'SellerParty_Name': 'Seller OÜ', 'RegNumber': '10000001',
+        'SellerParty_extensionId': 'eakSellerCode', 'SellerParty_InformationContent': False,
+        'BuyerParty_Name': 'Buyer "AS"', 'BuyerParty_RegNumber': '20000002',
+        'BuyerParty_extensionId': False, 'BuyerParty_InformationContent': '',
+    },
+    'InvoiceInformation': {'Type': 'DEB', 'DocumentName': 'ARVE', 'InvoiceNumber': 'INV/2024/00001', 'InvoiceDate': '2024-01-15'},
+    'InvoiceSumGroup_InvoiceSum': '90.00',
+    'InvoiceSumGroup_Rounding': None,
+    'InvoiceSumGroup_TotalVATSum': '19.80',
+    'InvoiceSumGroup_TotalSum': '109.80',
+    'InvoiceSumGroup_TotalToPay': '109.80',
+    'invoice_lines': [LINE_VALS, dict(LINE_VALS, Addition_AddRate=False, VAT_VATRate=0.0)],
+    'AttachmentFile': {'FileName': 'INV_2024_00001.pdf', 'FileBase64': '___EAK_FILE_BASE64___'},
+    'PaymentInfo': {
+        'Currency': 'EUR', 'PaymentDescription': 'INV/2024/00001', 'Payable': 'YES', 'PayDueDate': '2024-02-15',
+        'PaymentTotalSum': '109.80', 'PayerName': 'Buyer "AS"', 'PaymentId': 'RF18', 'PayToAccount': 'EE382200221020145685',
+        'PayToName': 'Seller OÜ',
+    },
+    'Footer': {'TotalNumberInvoices': 1, 'TotalAmount': '109.80'},
+}
+# stand-in for the e-invoice schema, strict on the few elements it declares
+XSD = b"""<xs:schema xmlns:xs="http://www.w3.org/2001/XMLSchema">
+    <xs:complexType name="open">
+        <xs:sequence><xs:any processContents="lax" minOccurs="0" maxOccurs="unbounded"/></xs:sequence>
+        <xs:anyAttribute processContents="lax"/>
+    </xs:complexType>
+    <xs:element name="E_Invoice" type="open"/>
+    <xs:element name="RegNumber">
+        <xs:simpleType><xs:restriction base="xs:string"><xs:pattern value="[0-9]{8}"/></xs:restriction></xs:simpleType>
+    </xs:element>
+    <xs:element name="FileBase64" type="xs:base64Binary"/>
+</xs:schema>"""
+
+
+def _canonical(xml):
+    """ Whitespace between the elements of a template is not significant for eAK. """
+    tree = etree.fromstring(xml, parser=etree.XMLParser(remove_blank_text=True))
+    return etree.tostring(tree, method='c14n')
+
+
+@tagged('post_install', '-at_install')
+class TestEakEnvelopes(TransactionCase):
+
+    def _golden(self, file_name):
+        with file_open(f'account_edi_eak/tests/data/{file_name}', 'rb') as file:
+            return file.read()
+
+    def test_request_envelopes_match_templates(self):
+        for template, builder, vals, file_name in CASES:
+            with self.subTest(template=template):
+                built = builder(vals)
+                self.assertEqual(built, self._golden(file_name))
+                rendered = self.env['ir.qweb']._render(template, {'vals': vals})
+                self.assertEqual(_canonical(built), _canonical(str(rendered).encode()))
+
+    def test_e_invoice_envelope_matches_template(self):
+        built = envelopes.e_invoice_request(EXPORT_VALS)
+        self.assertEqual(etree.tostring(built, encoding='UTF-8'), self._golden('e_invoice_request.xml'))
+        rendered = self.env['ir.qweb']._render('account_edi_eak.account_invoice_edi_eak_export', {'vals': EXPORT_VALS})
+        # the bytes sent to eAK, both cleaned up the same way
+        self.assertEqual(
+            etree.tostring(cleanup_xml_node(built, remove_blank_nodes=False), xml_declaration=True, encoding='UTF-8'),
+            etree.tostring(cleanup_xml_node(rendered, remove_blank_nodes=False), xml_declaration=True, encoding='UTF-8'),
+        )
+
+
+class _RefusingEak:
+    """ Stands for the eAK client: refuses every envelope holding one of ``refused`` invoice ids,
+        or only those invoices of it when ``per_invoice``.
+    """
+
+    def __init__(self, refused, per_invoice=False):
+        self.refused = refused
+        self.per_invoice = per_invoice
+        self.envelopes = []
+
+    def sendCustomerInvoice(self, data=None):
+        tree = etree.fromstring(b''.join(data()))
+        invoice_ids = [invoice.get('invoiceId') for invoice in tree.iter('Invoice')]
+        self.envelopes.append((invoice_ids, tree.findtext('.//Footer/TotalNumberInvoices')))
+        if self.per_invoice:
+            return {'level': 'info', 'row': 'received', 'invoices': {
+                invoice_id: {'level': 'error', 'fault_code': '12', 'fault_string': '12 : refused', 'row': f'refused {invoice_id}'}
+                if invoice_id in self.refused else {'level': 'info', 'fault_code': '', 'fault_string': '', 'row': f'accepted {invoice_id}'}
+                for invoice_id in invoice_ids
+            }}
+        if self.refused.intersection(invoice_ids):
+            return {'level': 'error', 'fault_code': 'SOAP-ENV:Client', 'fault_string': 'refused', 'row': 'refused'}
+        return {'level': 'info', 'row': 'accepted'}
+
+
+@tagged('post_install', '-at_install')
+class TestEakBatchedInvoices(AccountTestInvoicingCommon):
+
+    def test_refused_envelope_is_bisected(self):
+        invoices = self.env['account.move'].concat(*[self.init_invoice('out_invoice', amounts=[100]) for _i in range(4)])
+        invoices_vals = {
+            invoice: dict(EXPORT_VALS,
+                          Invoice=dict(EXPORT_VALS['Invoice'], invoiceId=invoice.id),
+                          AttachmentFile={'FileName': 'invoice.pdf', 'FileBase64': EXPORT_VALS['AttachmentFile']['FileBase64'],
+                                          'open': lambda: io.BytesIO(b'%PDF-1.4')})
+            for invoice in invoices
+        }
+        eak = _RefusingEak({str(invoices[2].id)})
+        responses = {}
+        self.env.company._eak_run_concurrently(
+            lambda company: self.env['account.edi.format']._eak_send_envelope(eak, invoices, invoices_vals, responses))
+
+        ids = [str(invoice.id) for invoice in invoices]
+        self.assertEqual(eak.envelopes, [(ids, '4'), (ids[:2], '2'), (ids[2:], '2'), (ids[2:3], '1'), (ids[3:], '1')])
+        self.assertEqual([responses[invoice]['level'] for invoice in invoices], ['info', 'info', 'error', 'info'])
+
+    def test_only_refused_invoices_are_sent_again(self):
+        invoices = self.env['account.move'].concat(*[self.init_invoice('out_invoice', amounts=[100]) for _i in range(4)])
+        invoices_vals = {
+            invoice: dict(EXPORT_VALS,
+                          Invoice=dict(EXPORT_VALS['Invoice'], invoiceId=invoice.id),
+                          AttachmentFile={'FileName': 'invoice.pdf', 'FileBase64': EXPORT_VALS['AttachmentFile']['FileBase64'],
+                                          'open': lambda: io.BytesIO(b'%PDF-1.4')})
+            for invoice in invoices
+        }
+        ids = [str(invoice.id) for invoice in invoices]
+        eak = _RefusingEak({ids[1], ids[2]}, per_invoice=True)
+        responses = {}
+        self.env.company._eak_run_concurrently(
+            lambda company: self.env['account.edi.format']._eak_send_envelope(eak, invoices, invoices_vals, responses))
+
+        self.assertEqual(eak.envelopes, [(ids, '4'), (ids[1:3], '2'), (ids[1:2], '1'), (ids[2:3], '1')])
+        self.assertEqual([responses[invoice]['level'] for invoice in invoices], ['info', 'error', 'error', 'info'])
+        self.assertEqual(responses[invoices[0]]['row'], f'accepted {ids[0]}')
+        self.assertEqual(responses[invoices[2]]['row'], f'refused {ids[2]}')
+
+    def test_invoice_results_are_parsed(self):
+        answer = '''<SOAP-ENV:Envelope xmlns:SOAP-ENV="http://schemas.xmlsoap.org/soap/envelope/"><SOAP-ENV:Body>
+            <erp:EInvoiceResponse xmlns:erp="http://e-arvetekeskus.eu/erp"><ErrorCode>0</ErrorCode>
+                <erp:InvoiceResult invoiceId="1"><ErrorCode>0</ErrorCode></erp:InvoiceResult>
+                <erp:InvoiceResult invoiceId="2"><ErrorCode>12</ErrorCode><ErrorMessage>Unknown buyer</ErrorMessage></erp:InvoiceResult>
+            </erp:EInvoiceResponse></SOAP-ENV:Body></SOAP-ENV:Envelope>'''
+        eAk_response = EstonianEInvoice('http://127.0.0.1:9/')._process_eAK_response(SimpleNamespace(text=answer, status_code=200))
+        self.assertEqual(eAk_response['level'], 'info')
+        self.assertEqual(eAk_response['invoices']['1']['level'], 'info')
+        self.assertEqual(eAk_response['invoices']['2']['fault_string'], '12 : Unknown buyer')
+        self.assertIn('Unknown buyer', eAk_response['invoices']['2']['row'])
+
+    def test_batch_validation(self):
+        edi_format = self.env.ref('account_edi_eak.edi_in_invoice_eak')
+        self.partner_a.company_registry = '20000002'
+        self.partner_b.company_registry = False
+        query_counts = []
+        for count in (2, 10):
+            invoices = self.env['account.move'].concat(*[
+                self.init_invoice('out_invoice', partner=partner, amounts=[100])
+                for partner in (self.partner_a, self.partner_b) * (count // 2)
+            ])
+            self.env.invalidate_all()
+            sql_log_count = self.env.cr.sql_log_count
+            errors = edi_format._check_moves_configuration(invoices)
+            query_counts.append(self.env.cr.sql_log_count - sql_log_count)
+            self.assertEqual(set(errors), set(invoices.filtered(lambda invoice: invoice.partner_id == self.partner_b)))
+            self.assertIn("Please add Company ID value into Partner", errors[invoices[1]])
+        self.assertEqual(query_counts[0], query_counts[1])
+
+    def test_invoice_pdf_rendered_once_per_version(self):
+        self.company_data['company'].eak_bank_id = self.env['res.partner.bank'].create({
+            'acc_number': 'EE38 2200 2210 2014 5685',
+            'partner_id': self.company_data['company'].partner_id.id,
+        })
+        invoice = self.init_invoice('out_invoice', amounts=[100])
+        with patch.object(self.env.registry['account.move'], 'get_invoice_pdf_report_attachment',
+                          return_value=(b'%PDF-1.4', 'invoice.pdf')) as render:
+            digests = {invoice._prepared_eak_invoice()['digest'] for _i in range(2)}
+            self.assertEqual((len(digests), render.call_count), (1, 1))
+
+            invoice.invoice_date_due = '2099-12-31'
+            vals = invoice._prepared_eak_invoice()
+            self.assertNotIn(vals['digest'], digests)
+            self.assertEqual(render.call_count, 2)
+            with vals['AttachmentFile']['open']() as pdf:
+                self.assertEqual(pdf.read(), b'%PDF-1.4')
+
+            # only shown in the PDF, not exported
+            invoice.narration = "Thank you"
+            self.assertEqual(invoice._prepared_eak_invoice()['digest'], vals['digest'])
+            self.assertEqual(render.call_count, 3)
+        # kept out of the attachments of the invoice
+        self.assertFalse(self.env['ir.attachment'].search([('res_model', '=', 'account.move'), ('res_id', '=', invoice.id),
+                                                           ('mimetype', '=', 'application/pdf')]))
+        cached = self.env['ir.attachment'].search([('res_model', '=', 'account.move'), ('res_id', '=', invoice.id),
+                                                   ('res_field', '=', 'eak_invoice_pdf_id')])
+        self.assertEqual(cached, invoice.eak_invoice_pdf_id)
+
+    def test_schema_mismatch_is_a_warning(self):
+        company = self.company_data['company']
+        company.write({'company_registry': '10000001', 'eak_url': 'http://127.0.0.1:9/', 'eak_auth': 'test_auth',
+                       'street': 'Narva mnt 5', 'city': 'Tallinn'})
+        company.eak_bank_id = self.env['res.partner.bank'].create({
+            'acc_number': 'EE382200221020145685',
+            'partner_id': company.partner_id.id,
+        })
+        self.partner_a.write({'company_registry': 'R&D', 'street': 'Narva mnt 7', 'city': 'Tallinn'})
+        invoice = self.init_invoice('out_invoice', amounts=[100])
+        invoice.partner_bank_id = company.eak_bank_id
+        edi_eak = self.env['account.edi.xml.edi_eak']
+        # the checks shipped with the module
+        self.assertEqual(edi_eak._eak_check_schema({invoice: invoice._prepared_eak_invoice(embed_pdf=False)}), {})
+        # nor is a due date
+        invoice.invoice_date_due = False
+        self.assertEqual(invoice._prepared_eak_invoice(embed_pdf=False)['PaymentInfo']['PayDueDate'], '')
+        self.assertEqual(edi_eak._eak_check_schema({invoice: invoice._prepared_eak_invoice(embed_pdf=False)}), {})
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'e-invoice_ver1.2.xsd')
+            with open(path, 'wb') as xsd:
+                xsd.write(XSD)
+            self.env['ir.config_parameter'].set_param('account_edi_eak.xsd_path', path)
+            self.assertIs(edi_eak._eak_get_schema()[0], edi_eak._eak_get_schema()[0])
+            with patch.object(self.env.registry['account.move'], 'get_invoice_pdf_report_attachment',
+                              return_value=(b'%PDF-1.4', 'invoice.pdf')), \
+                 patch.object(EstonianEInvoice, 'sendCustomerInvoice', return_value={'level': 'info', 'row': 'accepted'}) as send, \
+                 self.assertLogs('odoo.addons.account_edi_eak.models.account_edi_xml_edi_eak', level='WARNING') as logs:
+                result = self.env.ref('account_edi_eak.edi_in_invoice_eak')._account_edi_eak(invoice)[invoice]
+            self.assertEqual(send.call_count, 1)
+            self.assertTrue(result['success'])
+            self.assertIn("InvoiceParties > BuyerParty > RegNumber", logs.output[0])
+            self.assertNotIn("SellerParty", logs.output[0])
+            self.assertIn("InvoiceParties > BuyerParty > RegNumber", invoice.eak_edi_summary)
+
+            self.partner_a.company_registry = '20000002'
+            self.assertEqual(edi_eak._eak_check_schema({invoice: invoice._prepared_eak_invoice(embed_pdf=False)}), {})
+
+    def test_batch_line_serialization(self):
+        tax_a, tax_b = self.company_data['default_tax_sale'], self.tax_sale_b
+        for currency in (self.company_data['currency'], self.currency_data['currency']):
+            invoice = self.env['account.move'].create({
+                'move_type': 'out_invoice',
+                'partner_id': self.partner_a.id,
+                'invoice_date': '2024-01-15',
+                'currency_id': currency.id,
+                'invoice_line_ids': [(0, 0, {
+                    'product_id': self.product_a.id,
+                    'quantity': quantity,
+                    'price_unit': price_unit,
+                    'discount': discount,
+                    'tax_ids': [(6, 0, taxes.ids)],
+                }) for quantity, price_unit, discount, taxes in (
+                    (1, 100.0, 0, tax_a), (3, 33.33, 10, tax_a), (2.5, 19.99, 0, tax_a + tax_b),
+                    (7, 0.01, 0, tax_b), (1, 80.0, 12.5, self.env['account.tax']),
+                )],
+            })
+            lines = invoice.invoice_line_ids
+            with self.subTest(currency=currency.name):
+                self.assertEqual(lines._prepared_eak_invoice_lines(invoice.format_monetary),
+                                 [line._prepared_eak_invoice_line(invoice.format_monetary) for line in lines])
+
+
+@tagged('post_install', '-at_install', 'eak_benchmark', '-standard')
+class TestEakEnvelopesBenchmark(TransactionCase):
+
+    def _time(self, render, count):
+        start = time.perf_counter()
+        for _i in range(count):
+            render()
+        return (time.perf_counter() - start) / count * 1e6
+
+    def test_render_time(self):
+        count = 200
+        status_vals = {'authPhrase': 'test_auth', 'regNumbers': [str(10000000 + index) for index in range(90)]}
+        export_vals = dict(EXPORT_VALS, invoice_lines=[LINE_VALS] * 50)
+        qweb = self.env['ir.qweb']
+        for name, template, builder, vals in (
+            ('company status, 90 registries', 'account_edi_eak.company_status_code_import', envelopes.company_status_request, status_vals),
+            ('e-invoice, 50 lines', 'account_edi_eak.account_invoice_edi_eak_export', envelopes.e_invoice_request, export_vals),
+        ):
+            qweb_us = self._time(lambda: qweb._render(template, {'vals': vals}), count)
+            builder_us = self._time(lambda: builder(vals), count)
+            _logger.info("eAK envelope %s: %.0f us with QWeb, %.0f us with lxml", name, qweb_us, builder_us)
+            self.assertLess(builder_us, qweb_us)
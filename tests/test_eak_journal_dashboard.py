@@ -0,0 +1,29 @@
+from odoo.tests import tagged
+from odoo.addons.account.tests.common import AccountTestInvoicingCommon
+
+
+@tagged('post_install', '-at_install')
+class TestEakJournalDashboard(AccountTestInvoicingCommon):
+
+    @classmethod
+    def setUpClass(cls, chart_template_ref=None):
+        super().setUpClass(chart_template_ref=chart_template_ref)
+        edi_format = cls.env.ref('account_edi_eak.edi_in_invoice_eak')
+        cls.invoices = cls.env['account.move'].concat(*[cls.init_invoice('out_invoice', amounts=[100], post=True) for _i in range(3)])
+        cls.documents = cls.env['account.edi.document'].create([
+            {'move_id': invoice.id, 'edi_format_id': edi_format.id, 'state': 'to_send'}
+            for invoice in cls.invoices
+        ])
+
+    def test_dashboard_counters_are_cached(self):
+        journal = self.invoices.journal_id
+        self.documents[0].write({'error': "refused", 'blocking_level': 'error'})
+        journal._eak_invalidate_dashboard()
+        counters = journal._eak_dashboard_counters()[journal.id]
+        self.assertEqual((counters['eak_invoices_pending'], counters['eak_invoices_failed']), (2, 1))
+
+        self.documents[1].state = 'sent'
+        self.documents.flush_recordset()
+        self.assertEqual(journal._eak_dashboard_counters()[journal.id]['eak_invoices_pending'], 2)
+        journal._eak_invalidate_dashboard()
+        self.assertEqual(journal._eak_dashboard_counters()[journal.id]['eak_invoices_pending'], 1)
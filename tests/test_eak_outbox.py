@@ -0,0 +1,48 @@
+from functools import partial
+from unittest.mock import patch
+from odoo.tests import tagged
+from odoo.addons.account.tests.common import AccountTestInvoicingCommon
+
+
+@tagged('post_install', '-at_install')
+class TestEakOutbox(AccountTestInvoicingCommon):
+
+    @classmethod
+    def setUpClass(cls, chart_template_ref=None):
+        super().setUpClass(chart_template_ref=chart_template_ref)
+        cls.edi_format = cls.env.ref('account_edi_eak.edi_in_invoice_eak')
+        cls.invoices = cls.env['account.move'].concat(*[cls.init_invoice('out_invoice', amounts=[100], post=True) for _i in range(3)])
+        cls.documents = cls.env['account.edi.document'].create([
+            {'move_id': invoice.id, 'edi_format_id': cls.edi_format.id, 'state': 'to_send'}
+            for invoice in cls.invoices
+        ])
+        cls.outbox_cron = cls.env.ref('account_edi_eak.ir_cron_eak_outbox')
+
+    def _triggers(self):
+        return self.env['ir.cron.trigger'].search_count([('cron_id', '=', self.outbox_cron.id)])
+
+    def test_documents_are_queued_then_drained(self):
+        sent = []
+
+        def post_walk(edi_format, invoices):
+            yield partial(sent.append, invoices.ids)
+            return {
+                invoice: {'error': "refused", 'blocking_level': 'error'} if invoice == self.invoices[0] else {'success': True}
+                for invoice in invoices
+            }
+
+        triggers = self._triggers()
+        self.documents._process_documents_web_services()
+        self.assertEqual(self._triggers(), triggers + 1)
+        self.assertEqual(self.invoices.mapped('eak_outbox_state'), ['queued'] * 3)
+
+        with patch.object(type(self.edi_format), '_eak_post_walk', post_walk):
+            self.env['account.edi.document']._cron_process_eak_outbox(batch_size=2)
+            self.assertEqual(sent, [self.invoices[:2].ids])
+            self.assertEqual(self._triggers(), triggers + 2)
+            self.assertEqual(self.invoices.mapped('eak_outbox_state'), ['failed', 'sent', 'queued'])
+
+            self.env['account.edi.document']._cron_process_eak_outbox(batch_size=2)
+            self.assertEqual(sent, [self.invoices[:2].ids, self.invoices[2:].ids])
+        self.assertEqual(self.invoices.mapped('eak_outbox_state'), ['failed', 'sent', 'sent'])
+        self.assertEqual(self.documents[0].error, "refused")
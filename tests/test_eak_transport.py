@@ -0,0 +1,173 @@
+import os
+import time
+import logging
+import tempfile
+import requests
+from functools import partial
+from odoo.tests import tagged
+from odoo.tests.common import TransactionCase
+from odoo.addons.account_edi_eak.models.account_edi_eak import EstonianEInvoice, EakRateLimiter, get_metrics, BREAKER_FAILURES, \
+    RecordingTransport, ReplayTransport, LiveTransport, _get_session
+from .common import EakStubServer, SyntheticEak
+
+_logger = logging.getLogger(__name__)
+
+
+HEADERS = {'SOAPAction': '"CompanyStatusRequest"', 'Content-Type': 'text/xml'}
+BODY = b'<soapenv:Envelope xmlns:soapenv="http://schemas.xmlsoap.org/soap/envelope/"/>'
+
+
+class TestEakRunConcurrently(TransactionCase):
+
+    def test_company_walks_overlap(self):
+        companies = self.env['res.company'].create([{'name': f'eAK company {index}'} for index in range(3)])
+
+        def walk(company):
+            first = yield partial(time.sleep, 0.5)
+            second = yield partial(str.upper, company.name)
+            return first, second
+
+        start = time.perf_counter()
+        results = companies._eak_run_concurrently(walk)
+        self.assertLess(time.perf_counter() - start, 1.2)
+        self.assertEqual(results, {company: (None, company.name.upper()) for company in companies})
+
+    def test_failing_walk_is_rolled_back_alone(self):
+        companies = self.env['res.company'].create([{'name': f'eAK company {index}'} for index in range(2)])
+
+        def walk(company):
+            yield partial(str, company.name)
+            company.name += ' synced'
+            if company == companies[0]:
+                raise ValueError("refused")
+            return 'done'
+
+        with self.assertLogs('odoo.addons.account_edi_eak.models.res_company', 'ERROR'):
+            results = companies._eak_run_concurrently(walk)
+        self.assertEqual(results[companies[0]]['fault_string'], "refused")
+        self.assertEqual(results[companies[1]], 'done')
+        self.assertEqual(companies.mapped('name'), ['eAK company 0', 'eAK company 1 synced'])
+
+
+class TestEakInstrumentation(TransactionCase):
+
+    def test_metrics_and_redacted_payloads(self):
+        body = b'<soapenv:Envelope><erp:CompanyStatusRequest authPhrase="s3cret"/>' + b'x' * 4096 + b'</soapenv:Envelope>'
+        before = get_metrics().get('CompanyStatusRequest', {'calls': 0, 'bytes_sent': 0})
+        with EakStubServer() as server, self.assertLogs('odoo.addons.account_edi_eak.models.account_edi_eak', 'INFO') as logs:
+            EstonianEInvoice(server.url, log_sample_rate=1).getClientStatus(body)
+        metrics = get_metrics()['CompanyStatusRequest']
+        self.assertEqual(metrics['calls'], before['calls'] + 1)
+        self.assertEqual(metrics['bytes_sent'], before['bytes_sent'] + len(body))
+        self.assertEqual(sum(metrics['timings']['wait']['buckets']), metrics['calls'])
+        output = '\n'.join(logs.output)
+        self.assertNotIn('s3cret', output)
+        self.assertIn('authPhrase="***"', output)
+        self.assertIn('(%d bytes)' % len(body), output)
+
+    def test_streamed_answer_closed_when_parser_fails(self):
+        responses = []
+
+        def parser(response):
+            responses.append(response)
+            raise ValueError("unreadable answer")
+
+        with EakStubServer() as server, self.assertLogs('odoo.addons.account_edi_eak.models.account_edi_eak', 'WARNING'):
+            eAk_response = EstonianEInvoice(server.url)._synch_with_eAK_api(headers=HEADERS, data=BODY, parser=parser)
+        self.assertEqual(eAk_response['fault_code'], 'server')
+        self.assertTrue(responses[0].raw.closed)
+
+
+class TestEakRecordReplay(TransactionCase):
+
+    def _without_timings(self, response):
+        response = {key: value for key, value in response.items() if key != 'timings'}
+        if 'records' in response:
+            # the raw XML of the records is read back from their spool
+            response['records'] = [dict(record, raw=record['raw']()) for record in response['records']]
+        return response
+
+    def test_replay_matches_live(self):
+        synthetic = SyntheticEak('10000001', bills=5, lines=2)
+        status_body = b'<soapenv:Envelope xmlns:soapenv="http://schemas.xmlsoap.org/soap/envelope/" ' \
+                      b'xmlns:erp="http://e-arvetekeskus.eu/erp"><soapenv:Body><erp:CompanyStatusRequest authPhrase="s3cret">' \
+                      b'<erp:RegNumber>30000000</erp:RegNumber></erp:CompanyStatusRequest></soapenv:Body></soapenv:Envelope>'
+        export_body = b'<soapenv:Envelope xmlns:soapenv="http://schemas.xmlsoap.org/soap/envelope/" ' \
+                      b'xmlns:erp="http://e-arvetekeskus.eu/erp"><soapenv:Body><erp:BuyInvoiceExportRequest authPhrase="s3cret" ' \
+                      b'since="%s"/></soapenv:Body></soapenv:Envelope>' % synthetic.since.isoformat().encode()
+        with tempfile.TemporaryDirectory() as directory:
+            with EakStubServer(responder=synthetic.respond) as server:
+                client = EstonianEInvoice(server.url, transport=RecordingTransport(LiveTransport(_get_session(server.url)), directory))
+                live = [client.getClientStatus(status_body), client.getVendorBills(export_body)]
+            self.assertEqual(len(live[1]['records']), 5)
+            cassettes = os.listdir(directory)
+            self.assertEqual(len(cassettes), 2)
+            for name in cassettes:
+                with open(os.path.join(directory, name)) as file:
+                    self.assertNotIn('s3cret', file.read())
+
+            client = EstonianEInvoice('http://127.0.0.1:9/', transport=ReplayTransport(directory, latency=0.05))
+            start = time.perf_counter()
+            replayed = [client.getClientStatus(status_body), client.getVendorBills(export_body)]
+            self.assertGreaterEqual(time.perf_counter() - start, 0.1)
+            self.assertEqual([self._without_timings(response) for response in replayed],
+                             [self._without_timings(response) for response in live])
+            # unknown requests of a recorded action are answered in turn
+            self.assertEqual(self._without_timings(client.getClientStatus(b'<other/>')), self._without_timings(live[0]))
+
+
+class TestEakRateLimiter(TransactionCase):
+
+    def test_circuit_opens_then_probes(self):
+        limiter = EakRateLimiter(max_rate=100)
+        with EakStubServer(error_rate=1, error_status=503) as server:
+            client = EstonianEInvoice(server.url, retries=0, limiter=limiter)
+            for _i in range(BREAKER_FAILURES):
+                self.assertEqual(client.getClientStatus(BODY)['fault_code'], 'server')
+            self.assertLess(limiter.rate, 100)
+            response = client.getClientStatus(BODY)
+            self.assertEqual(response['fault_code'], 'throttled')
+            self.assertGreater(response['retry_after'], 0)
+            self.assertGreater(client.retry_after(), 0)
+            self.assertEqual(len(server.requests), BREAKER_FAILURES)
+
+        limiter.opened_until = time.monotonic()
+        with EakStubServer() as server:
+            client = EstonianEInvoice(server.url, retries=0, limiter=limiter)
+            self.assertNotEqual(client.getClientStatus(BODY).get('fault_code'), 'throttled')
+            self.assertEqual((limiter.state, client.retry_after()), ('closed', 0))
+
+    def test_bucket_paces_calls(self):
+        limiter = EakRateLimiter(max_rate=5)
+        start = time.perf_counter()
+        for _i in range(10):
+            self.assertEqual(limiter.acquire(), 0)
+        # a burst of 5 then 5 calls at 5 per second
+        self.assertGreater(time.perf_counter() - start, 0.8)
+        self.assertAlmostEqual(limiter.acquire(max_wait=0), 0.2, delta=0.05)
+
+
+@tagged('post_install', '-at_install', 'eak_benchmark', '-standard')
+class TestEakTransportBenchmark(TransactionCase):
+
+    def _run(self, send, count):
+        start = time.perf_counter()
+        for _i in range(count):
+            send()
+        return count / (time.perf_counter() - start)
+
+    def test_pooled_session_throughput(self):
+        count = 300
+        with EakStubServer() as server:
+            bare_rps = self._run(lambda: requests.request('POST', server.url, headers=HEADERS, data=BODY, timeout=60), count)
+            bare_connections = server.connections
+
+        with EakStubServer() as server:
+            client = EstonianEInvoice(server.url, pool_size=2)
+            pooled_rps = self._run(lambda: client.getClientStatus(BODY), count)
+            pooled_connections = server.connections
+
+        _logger.info("eAK transport: %.0f req/s bare (%s connections), %.0f req/s pooled (%s connections)",
+                     bare_rps, bare_connections, pooled_rps, pooled_connections)
+        self.assertEqual(bare_connections, count)
+        self.assertLessEqual(pooled_connections, 2)
@@ -0,0 +1,168 @@
+import gzip
+from datetime import timedelta
+from unittest.mock import patch
+from lxml import etree
+from odoo import fields
+from odoo.tests import tagged
+from odoo.addons.account.tests.common import AccountTestInvoicingCommon
+from odoo.addons.account_edi_eak.models.account_edi_eak import EstonianEInvoice
+from odoo.addons.account_edi_eak.models.res_company import EAK_COMMIT
+from .common import vendor_bill_xml
+
+
+@tagged('post_install', '-at_install')
+class TestImportEakVendorBills(AccountTestInvoicingCommon):
+
+    @classmethod
+    def setUpClass(cls, chart_template_ref=None):
+        super().setUpClass(chart_template_ref=chart_template_ref)
+        cls.env.ref('base.EUR').active = True
+        cls.company = cls.company_data['company']
+        cls.company.write({
+            'company_registry': '10000001',
+            'eak_url': 'https://fake-eak-url.com',
+            'eak_auth': 'test_auth',
+        })
+        cls.partner_a.write({'company_registry': '20000002', 'is_company': True})
+        cls.product_a.default_code = 'EAK-A'
+        cls.tax_purchase = cls.company_data['default_tax_purchase']
+        cls.eak_client = EstonianEInvoice('http://127.0.0.1/')
+
+    def _records(self, count, line_count=5):
+        return [
+            self.eak_client._parse_vendor_bill(etree.fromstring(vendor_bill_xml(
+                f'{count}-{index}', '10000001', '20000002', line_count=line_count,
+                default_code='EAK-A', vat_rate=self.tax_purchase.amount,
+            )))
+            for index in range(count)
+        ]
+
+    def test_prepared_import_eak_invoice(self):
+        vals, errors = self.env['account.journal']._prepared_import_eak_invoice(self._records(1))
+        self.assertFalse(errors)
+        self.assertEqual(vals[0]['company_id'], self.company.id)
+        self.assertEqual(vals[0]['partner_id'], self.partner_a.id)
+        self.assertEqual(vals[0]['currency_id'], self.env.ref('base.EUR').id)
+        line_vals = vals[0]['invoice_line_ids'][0][2]
+        self.assertEqual(line_vals['product_id'], self.product_a.id)
+        self.assertEqual(line_vals['tax_ids'], [self.tax_purchase.id])
+
+    def test_master_data_query_count_is_constant(self):
+        journal = self.env['account.journal']
+        journal._prepared_import_eak_invoice(self._records(1))
+        query_counts = []
+        for count in (2, 50):
+            records = self._records(count)
+            self.env.invalidate_all()
+            sql_log_count = self.env.cr.sql_log_count
+            vals, errors = journal._prepared_import_eak_invoice(records)
+            query_counts.append(self.env.cr.sql_log_count - sql_log_count)
+            self.assertEqual(len(vals), count)
+            self.assertFalse(errors)
+        self.assertEqual(query_counts[0], query_counts[1])
+
+    def test_reimport_upserts_known_bills(self):
+        journal = self.env['account.journal']
+        records = self._records(3, line_count=1)
+        eAk_response = journal._process_eak_vendor_bill({'records': records})
+        self.assertEqual(eAk_response['row'], "3 created, 0 updated, 0 unchanged")
+
+        records[0] = dict(records[0], state='PAID', digest='changed')
+        eAk_response = journal._process_eak_vendor_bill({'records': records + records[1:]})
+        self.assertEqual(eAk_response['row'], "0 created, 1 updated, 2 unchanged")
+        moves = self.env['account.move'].search([('eak_edi_bill_id', 'in', [record['invoiceId'] for record in records])])
+        self.assertEqual(len(moves), 3)
+        self.assertEqual(moves.filtered(lambda move: move.eak_edi_bill_id == records[0]['invoiceId']).eak_edi_state, 'PAID')
+
+    def test_commit_after_each_chunk(self):
+        self.env['ir.config_parameter'].sudo().set_param('account_edi_eak.bill_chunk_size', 2)
+        records = self._records(5, line_count=1)
+        steps = self.env['account.journal']._eak_import_vendor_bills({'records': records})
+        created = []
+        for step in steps:
+            self.assertIs(step, EAK_COMMIT)
+            created.append(self.env['account.move'].search_count([('eak_edi_bill_id', 'in', [record['invoiceId'] for record in records])]))
+        self.assertEqual(created, [2, 4, 5])
+
+    def test_raw_xml_is_stored_compressed(self):
+        records = self._records(1, line_count=1)
+        self.env['account.journal']._process_eak_vendor_bill({'records': records})
+        move = self.env['account.move'].search([('eak_edi_bill_id', '=', records[0]['invoiceId'])])
+        payload = move.eak_edi_payload_id
+        self.assertEqual(payload.mimetype, 'application/gzip')
+        self.assertEqual(gzip.decompress(payload.raw).decode(), records[0]['raw']())
+        self.assertEqual(move.eak_edi_summary, records[0]['state'])
+        action = move.action_view_eak_edi_response()
+        self.assertEqual(self.env[action['res_model']].browse(action['res_id']).content, records[0]['raw']())
+
+        self.env['account.journal']._process_eak_vendor_bill({'records': [dict(records[0], state='PAID', digest='changed')]})
+        self.assertFalse(payload.exists())
+        self.assertEqual((move.eak_edi_summary, move._eak_payload()), ('PAID', records[0]['raw']()))
+
+        move.action_post()
+        move.button_draft()
+        self.assertFalse(move.eak_edi_payload_id)
+        self.assertFalse(move._eak_payload())
+
+    def test_bad_bills_are_quarantined(self):
+        journal = self.env['account.journal']
+        self.env['ir.config_parameter'].sudo().set_param('account_edi_eak.bill_chunk_size', 2)
+        records = [
+            self.eak_client._parse_vendor_bill(etree.fromstring(vendor_bill_xml(
+                invoice_id, '10000001', seller_registry, line_count=1, default_code='EAK-A', vat_rate=self.tax_purchase.amount,
+            )))
+            for invoice_id, seller_registry in (('Q-0', '20000002'), ('Q-1', '99999999'), ('Q-2', '20000002'),
+                                                ('not-created', '20000002'), ('Q-4', '20000002'))
+        ]
+        create = type(self.env['account.move']).create
+
+        def create_or_fail(moves, vals_list):
+            if any(vals['eak_edi_bill_id'] == 'not-created' for vals in vals_list):
+                raise ValueError("creation refused")
+            return create(moves, vals_list)
+        with patch.object(type(self.env['account.move']), 'create', create_or_fail):
+            eAk_response = journal._process_eak_vendor_bill({'records': records})
+        self.assertEqual(eAk_response['row'], "3 created, 0 updated, 0 unchanged, 2 quarantined")
+        quarantined = self.env['account.edi.eak.bill.quarantine'].search([('company_id', '=', self.company.id)])
+        self.assertEqual(sorted(quarantined.mapped('eak_edi_bill_id')), ['Q-1', 'not-created'])
+        self.assertIn("99999999", quarantined.filtered(lambda entry: entry.eak_edi_bill_id == 'Q-1').reason)
+        self.assertIn("creation refused", quarantined.filtered(lambda entry: entry.eak_edi_bill_id == 'not-created').reason)
+
+        self.partner_b.write({'company_registry': '99999999', 'is_company': True})
+        quarantined.action_retry()
+        self.assertFalse(quarantined.exists())
+        self.assertEqual(self.env['account.move'].search_count([('eak_edi_bill_id', 'in', ['Q-1', 'not-created'])]), 2)
+
+    def test_items_without_vat_and_malformed_rates(self):
+        records = [
+            self.eak_client._parse_vendor_bill(etree.fromstring(vendor_bill_xml(
+                invoice_id, '10000001', '20000002', line_count=1, default_code='EAK-A', vat_rate=self.tax_purchase.amount,
+            )))
+            for invoice_id in ('NO-VAT', 'BAD-VAT', 'VAT')
+        ]
+        records[0]['lines'][0]['VATRate'] = ''
+        records[1]['lines'][0]['VATRate'] = 'n/a'
+        eAk_response = self.env['account.journal']._process_eak_vendor_bill({'records': records})
+        self.assertEqual(eAk_response['row'], "2 created, 0 updated, 0 unchanged, 1 quarantined")
+        bills = self.env['account.move'].search([('eak_edi_bill_id', 'in', ['NO-VAT', 'VAT'])])
+        self.assertEqual({bill.eak_edi_bill_id: bill.invoice_line_ids.tax_ids for bill in bills},
+                         {'NO-VAT': self.env['account.tax'], 'VAT': self.tax_purchase})
+        quarantined = self.env['account.edi.eak.bill.quarantine'].search([('eak_edi_bill_id', '=', 'BAD-VAT')])
+        self.assertIn("n/a", quarantined.reason)
+
+    @patch('odoo.addons.account_edi_eak.models.account_edi_eak.EstonianEInvoice.getVendorBills')
+    def test_export_windows_adapt_to_cap(self, mock_get_vendor_bills):
+        now = fields.Datetime.now()
+        self.company.write({'eak_bill_export_date': now - timedelta(days=2), 'eak_bill_export_window': 24 * 60})
+        capped = self._records(1, line_count=1) * 100
+
+        def get_vendor_bills(data):
+            return {'level': 'info', 'records': capped if mock_get_vendor_bills.call_count == 1 else []}
+        mock_get_vendor_bills.side_effect = get_vendor_bills
+
+        eAk_response = self.env['account.journal'].process_eak_vendor_bill(self.company._get_eak_client(), self.company)
+        self.assertEqual(eAk_response['level'], 'success')
+        # the capped first day is fetched again as half a day, then the empty windows grow
+        self.assertEqual(mock_get_vendor_bills.call_count, 4)
+        self.assertGreaterEqual(self.company.eak_bill_export_date, now)
+        self.assertEqual(self.company.eak_bill_export_window, 4 * 24 * 60)
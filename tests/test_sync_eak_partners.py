@@ -1,5 +1,8 @@
+from datetime import timedelta
+from odoo import fields
 from odoo.tests.common import TransactionCase
 from unittest.mock import patch
+from lxml import etree
 from odoo.exceptions import ValidationError
 
 class TestSyncEakPartners(TransactionCase):
@@ -47,4 +50,106 @@ class TestSyncEakPartners(TransactionCase):
         self.assertEqual(partner_1.is_edi_eak, True)
         self.assertEqual(partner_2.is_edi_eak, True) 
 
-        self.assertEqual(mock_get_client_status.call_count, 1)  # Modify based on the number of batches
\ No newline at end of file
+        self.assertEqual(mock_get_client_status.call_count, 1)  # Modify based on the number of batches
+
+        run = self.env['account.edi.eak.sync.run'].search([('job', '=', 'partners'), ('company_id', '=', self.company.id)])
+        self.assertRecordValues(run, [{'state': 'success', 'count_received': 2, 'count_updated': 2}])
+
+    def test_sync_runs_retention(self):
+        runs = self.env['account.edi.eak.sync.run'].create([
+            {'job': 'partners', 'company_id': self.company.id, 'date_start': date_start}
+            for date_start in (fields.Datetime.now() - timedelta(days=60), fields.Datetime.now())
+        ])
+        self.env['account.edi.eak.sync.run']._gc_sync_runs()
+        self.assertEqual(runs.exists(), runs[1])
+
+    @patch('odoo.addons.account_edi_eak.models.res_partner.EAK_STATUS_BATCH_SIZE', 1)
+    @patch('odoo.addons.account_edi_eak.models.account_edi_eak.EstonianEInvoice.getClientStatus')
+    def test_sync_merges_every_batch(self, mock_get_client_status):
+
+        def get_client_status(data):
+            reg_numbers = etree.fromstring(data).xpath('//*[local-name()="RegNumber"]/text()')
+            company_active = "".join(f'<erp:CompanyActive regNumber="{reg}">YES</erp:CompanyActive>' for reg in reg_numbers)
+            return {'row': f"""
+                <SOAP-ENV:Envelope xmlns:SOAP-ENV="http://schemas.xmlsoap.org/soap/envelope/">
+                    <SOAP-ENV:Body>
+                        <erp:CompanyStatusResponse xmlns:erp="http://e-arvetekeskus.eu/erp">{company_active}</erp:CompanyStatusResponse>
+                    </SOAP-ENV:Body>
+                </SOAP-ENV:Envelope>"""}
+        mock_get_client_status.side_effect = get_client_status
+
+        self.env['res.partner']._cron_sync_eak_partners()
+
+        self.assertEqual(mock_get_client_status.call_count, len(set(self.partners.mapped('company_registry'))))
+        self.assertTrue(all(self.partners.mapped('is_edi_eak')))
+
+    @patch('odoo.addons.account_edi_eak.models.res_partner.EAK_STATUS_BATCH_SIZE', 1)
+    @patch('odoo.addons.account_edi_eak.models.account_edi_eak.EstonianEInvoice.getClientStatus')
+    def test_sync_applies_the_batches_answered(self, mock_get_client_status):
+
+        def get_client_status(data):
+            reg_numbers = etree.fromstring(data).xpath('//*[local-name()="RegNumber"]/text()')
+            if '789101' in reg_numbers:
+                return {'level': 'error', 'fault_code': 'server', 'fault_string': 'Service unavailable'}
+            company_active = "".join(f'<erp:CompanyActive regNumber="{reg}">YES</erp:CompanyActive>' for reg in reg_numbers)
+            return {'row': f"""
+                <SOAP-ENV:Envelope xmlns:SOAP-ENV="http://schemas.xmlsoap.org/soap/envelope/">
+                    <SOAP-ENV:Body>
+                        <erp:CompanyStatusResponse xmlns:erp="http://e-arvetekeskus.eu/erp">{company_active}</erp:CompanyStatusResponse>
+                    </SOAP-ENV:Body>
+                </SOAP-ENV:Envelope>"""}
+        mock_get_client_status.side_effect = get_client_status
+
+        self.env['res.partner']._cron_sync_eak_partners()
+
+        self.assertEqual(self.partners.mapped('is_edi_eak'), [True, False, True, True])
+        self.assertEqual([bool(checked_at) for checked_at in self.partners.mapped('eak_status_checked_at')], [True, False, True, True])
+        run = self.env['account.edi.eak.sync.run'].search([('job', '=', 'partners'), ('company_id', '=', self.company.id)])
+        self.assertEqual(run.state, 'error')
+        self.assertIn('Service unavailable', run.error)
+
+    @patch('odoo.addons.account_edi_eak.models.account_edi_eak.EstonianEInvoice.getClientStatus')
+    def test_sync_only_due_partners(self, mock_get_client_status):
+        mock_get_client_status.return_value = {'row': '''
+            <SOAP-ENV:Envelope xmlns:SOAP-ENV="http://schemas.xmlsoap.org/soap/envelope/">
+                <SOAP-ENV:Body><erp:CompanyStatusResponse xmlns:erp="http://e-arvetekeskus.eu/erp"/></SOAP-ENV:Body>
+            </SOAP-ENV:Envelope>'''}
+        self.env['res.partner']._cron_sync_eak_partners()
+        self.assertTrue(all(self.partners.mapped('eak_status_checked_at')))
+        self.assertEqual(mock_get_client_status.call_count, 1)
+
+        self.env['res.partner']._cron_sync_eak_partners()
+        self.assertEqual(mock_get_client_status.call_count, 1)
+
+        cron = self.env.ref('account_edi_eak.ir_cron_fetch_eak_values')
+        triggers = self.env['ir.cron.trigger'].search_count([('cron_id', '=', cron.id)])
+        self.partners[0].company_registry = '654321'
+        self.assertFalse(self.partners[0].eak_status_checked_at)
+        self.assertEqual(self.env['ir.cron.trigger'].search_count([('cron_id', '=', cron.id)]), triggers + 1)
+
+        self.partners[1].eak_status_checked_at = fields.Datetime.now() - timedelta(days=31)
+        self.env['res.partner']._cron_sync_eak_partners()
+        reg_numbers = etree.fromstring(mock_get_client_status.call_args.args[0]).xpath('//*[local-name()="RegNumber"]/text()')
+        self.assertEqual(sorted(reg_numbers), ['654321', '789101'])
+
+    @patch('odoo.addons.account_edi_eak.models.account_edi_eak.EstonianEInvoice.getClientStatus')
+    def test_registry_change_resets_status(self, mock_get_client_status):
+        mock_get_client_status.return_value = {'row': '''
+            <SOAP-ENV:Envelope xmlns:SOAP-ENV="http://schemas.xmlsoap.org/soap/envelope/">
+                <SOAP-ENV:Body><erp:CompanyStatusResponse xmlns:erp="http://e-arvetekeskus.eu/erp">
+                    <erp:CompanyActive regNumber="123456">YES</erp:CompanyActive>
+                </erp:CompanyStatusResponse></SOAP-ENV:Body>
+            </SOAP-ENV:Envelope>'''}
+        partner = self.partners[0]
+        action = partner.with_company(self.company).action_check_eak_status()
+        self.assertEqual(action['params']['type'], 'info')
+        reg_numbers = etree.fromstring(mock_get_client_status.call_args.args[0]).xpath('//*[local-name()="RegNumber"]/text()')
+        self.assertEqual(reg_numbers, ['123456'])
+        self.assertTrue(partner.is_edi_eak)
+
+        partner.company_registry = '123456'
+        self.assertTrue(partner.is_edi_eak)
+        self.assertTrue(partner.eak_status_checked_at)
+        partner.company_registry = '654321'
+        self.assertFalse(partner.is_edi_eak)
+        self.assertFalse(partner.eak_status_checked_at)
@@ -0,0 +1,11 @@
+# -*- coding: utf-8 -*-
+# Part of Odoo. See LICENSE file for full copyright and licensing details.
+from odoo import fields, models
+
+
+class AccountMoveEakResponse(models.TransientModel):
+    _name = 'account.move.eak.response'
+    _description = "eAK Response of a Move"
+
+    move_id = fields.Many2one('account.move', required=True, readonly=True, ondelete='cascade')
+    content = fields.Text('eAK Response', readonly=True)